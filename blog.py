@@ -1,18 +1,74 @@
 import os
 import re
+import json
+import logging
+import time
 import random
 import hashlib
 import hmac
-from string import letters
-import time
+import datetime
+import urllib
+from cStringIO import StringIO
 import webapp2
 import jinja2
 
+from google.appengine.api import datastore
+from google.appengine.api import memcache
+from google.appengine.api import users
+from google.appengine.datastore import datastore_query
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import db
 
+import jobs
+import markup
+import passwords
+import ratelimit
+import search
+import stats
+from cache import LRUCache, TieredCache
+
+developmentServer = os.environ.get('SERVER_SOFTWARE',
+                                   '').startswith('Development')
+
 template_dir = os.path.join(os.path.dirname(__file__), 'templates')
-jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir),
-                               autoescape=True)
+# Written by tools/compile_templates.py before deploying
+compiled_dir = os.path.join(os.path.dirname(__file__), 'templates_compiled')
+
+
+def template_loader():
+    # Production instances import the precompiled bundle instead of parsing
+    # templates/, so a cold start pays no template compilation.
+    if developmentServer or not os.path.isdir(compiled_dir):
+        return jinja2.FileSystemLoader(template_dir)
+    return jinja2.ModuleLoader(compiled_dir)
+
+jinja_env = jinja2.Environment(loader=template_loader(),
+                               autoescape=True,
+                               auto_reload=developmentServer)
+
+# Written by tools/build_static.py before deploying
+static_manifest_path = os.path.join(os.path.dirname(__file__),
+                                    'static_manifest.json')
+
+
+def load_static_manifest():
+    # Maps files in static/ to their fingerprinted copies. Without a build,
+    # or on the dev server, files are linked from /static as they are.
+    if developmentServer or not os.path.isfile(static_manifest_path):
+        return {}
+    with open(static_manifest_path) as f:
+        return json.load(f)
+
+static_manifest = load_static_manifest()
+
+
+def static_url(name):
+    built = static_manifest.get(name)
+    if built:
+        return '/static/build/' + built
+    return '/static/' + name
+
+jinja_env.globals['static_url'] = static_url
 
 # Nothing to see here, move along #############################################
 
@@ -22,19 +78,99 @@ secret = 'ROFLcoptor'
 
 
 def render_str(template, **params):
-    t = jinja_env.get_template(template)
-    return t.render(params)
+    with stats.rendering():
+        return jinja_env.get_template(template).render(params)
+
+
+# Number of posts shown per page on listings
+PAGE_SIZE = 10
+
+# Largest count a listing will report before giving up counting
+MAX_COUNT = 1000
+
+# Template chunks buffered together before each write when streaming
+STREAM_BUFFER = 20
+
+# Most comments loaded for a single post page
+MAX_COMMENTS = 500
+
+# Seconds a rendered post fragment stays in memcache
+RENDER_CACHE_TTL = 24 * 60 * 60
+
+# Part of every fragment key and page ETag. CURRENT_VERSION_ID changes with
+# each deploy, so template changes never serve fragments or 304s made by
+# the old templates.
+RENDER_KEY_VERSION = '%s.%d' % (os.environ.get('CURRENT_VERSION_ID', ''),
+                                markup.RENDER_VERSION)
+
+
+def iter_rendered(posts, batch_size=PAGE_SIZE):
+    # Renders posts from any iterable one batch at a time, so streaming a
+    # long listing holds a single batch of entities and fragments at once.
+    batch = []
+    for p in posts:
+        batch.append(p)
+        if len(batch) == batch_size:
+            for html in Post.render_multi(batch):
+                yield html
+            batch = []
+    if batch:
+        for html in Post.render_multi(batch):
+            yield html
+
+
+def fetch_page(query, cursor=None, size=PAGE_SIZE):
+    # Returns one page of results plus the cursor for the next page, or
+    # None when there is nothing left to show.
+    if cursor:
+        try:
+            query.with_cursor(cursor)
+        except db.BadValueError:
+            pass
+    results = query.fetch(size)
+    if len(results) < size:
+        return results, None
+    return results, query.cursor()
 
 
 def make_secure_val(val):
     return '%s|%s' % (val, hmac.new(secret, val).hexdigest())
 
 
+# Cookies this instance has already verified, so repeat visits skip the HMAC
+verified_cookies = LRUCache(capacity=1000, ttl=5 * 60)
+
+
 def check_secure_val(secure_val):
+    val = verified_cookies.get(secure_val)
+    if val is not None:
+        return val
     val = secure_val.split('|')[0]
     if secure_val == make_secure_val(val):
+        verified_cookies.set(secure_val, val)
         return val
 
+
+# Seconds shared caches may serve a page to anonymous readers
+PUBLIC_MAX_AGE = 60
+
+# Seconds a session remembers its own writes. Long enough to outlast index
+# replication, so the page a write redirects to always reflects it.
+RECENT_WRITES_TTL = 30
+
+
+def recent_writes_key(uid):
+    return 'recent_writes:%s' % uid
+
+# What a recent write did to its entity
+WRITE_CREATED = 'created'
+WRITE_UPDATED = 'updated'
+WRITE_DELETED = 'deleted'
+
+# Every write a client makes, on any route, also spends a token from here.
+# Routes opt in by listing their writing methods in rate_limits.
+WRITE_LIMIT = ratelimit.RateLimiter(rate=1, burst=30, prefix='writes:')
+
 # Base Blog Handler ##########################################################
 
 
@@ -50,6 +186,40 @@ class BlogHandler(webapp2.RequestHandler):
     def render(self, template, **kw):
         self.write(self.render_str(template, **kw))
 
+    def stream(self, template, **kw):
+        # Writes the page in chunks as Jinja2 generates it, so long listings
+        # are never joined into one string before being written out.
+        kw['user'] = self.user
+        with stats.rendering():
+            chunks = jinja_env.get_template(template).stream(kw)
+            chunks.enable_buffering(STREAM_BUFFER)
+            for chunk in chunks:
+                self.write(chunk)
+
+    def not_modified(self, parts):
+        # Sets validators and caching headers for a page built from `parts`.
+        # Returns True, with a 304 already set, when the client's copy is
+        # current so the caller can skip rendering. The page header shows
+        # the visitor, so the user id is part of the ETag. No page sends
+        # Last-Modified: likes, follows and posts dropping out of a listing
+        # all change a page without changing any post's last_modified.
+        uid = self.user and self.user.key().id()
+        etag = '"%s"' % hashlib.md5(repr((RENDER_KEY_VERSION, uid) +
+                                         tuple(parts))).hexdigest()
+        headers = self.response.headers
+        headers['ETag'] = etag
+        headers['Vary'] = 'Cookie'
+        if self.user:
+            headers['Cache-Control'] = 'private, max-age=0, must-revalidate'
+        else:
+            headers['Cache-Control'] = 'public, max-age=%d' % PUBLIC_MAX_AGE
+        tags = [t.strip() for t in
+                self.request.headers.get('If-None-Match', '').split(',')]
+        fresh = '*' in tags or etag in tags or 'W/' + etag in tags
+        if fresh:
+            self.response.set_status(304)
+        return fresh
+
     def set_secure_cookie(self, name, val):
         cookie_val = make_secure_val(val)
         self.response.headers.add_header(
@@ -68,9 +238,96 @@ class BlogHandler(webapp2.RequestHandler):
 
     def initialize(self, *a, **kw):
         webapp2.RequestHandler.initialize(self, *a, **kw)
+        stats.set_route(self.__class__.__name__)
         uid = self.read_secure_cookie('user_id')
         self.user = uid and User.by_id(int(uid))
 
+    # HTTP method -> ratelimit.RateLimiter for the routes that write, or
+    # None for a write with no budget of its own beyond WRITE_LIMIT
+    rate_limits = {}
+
+    def dispatch(self):
+        if self.request.method in self.rate_limits:
+            if not self.spend(self.rate_limits[self.request.method]):
+                return
+        return webapp2.RequestHandler.dispatch(self)
+
+    def spend(self, limiter=None):
+        # Spends a token from `limiter` and from WRITE_LIMIT. Returns False,
+        # with a 429 already written, when the client is over either.
+        client = self.client_id()
+        wait = (limiter and limiter.check(client)) or WRITE_LIMIT.check(client)
+        if wait:
+            self.response.set_status(429, 'Too Many Requests')
+            self.response.headers['Retry-After'] = str(wait)
+            self.write('Too many requests, try again in %d seconds.' % wait)
+            return False
+        return True
+
+    def client_id(self):
+        # Budgets follow the account when signed in, else the address
+        if self.user:
+            return 'u%d' % self.user.key().id()
+        return 'ip%s' % self.request.remote_addr
+
+    def record_write(self, key, created=False, deleted=False):
+        # Remembers a put or delete made by this session so that listings
+        # can show it before the eventually consistent queries catch up.
+        if not self.user:
+            return
+        cache_key = recent_writes_key(self.user.key().id())
+        writes = memcache.get(cache_key) or {}
+        if deleted:
+            writes[str(key)] = WRITE_DELETED
+        elif created or writes.get(str(key)) == WRITE_CREATED:
+            # An edit soon after creating still leaves the entity new
+            writes[str(key)] = WRITE_CREATED
+        else:
+            writes[str(key)] = WRITE_UPDATED
+        memcache.set(cache_key, writes, time=RECENT_WRITES_TTL)
+
+    def merge_recent(self, entities, kind, match=None, order=None, add=True,
+                     page_size=PAGE_SIZE):
+        # Overlays this session's recent writes of `kind` on query results.
+        # Deleted entities are dropped and updated ones are replaced by a
+        # fresh get. Created ones passing `match` are added when `add` is
+        # set; with `order`, only if they sort within a full page, since
+        # anything older belongs on a later page.
+        if not self.user:
+            return entities
+        writes = memcache.get(recent_writes_key(self.user.key().id())) or {}
+        keys = [db.Key(k) for k in writes if db.Key(k).kind() == kind]
+        if not keys:
+            return entities
+        fresh = dict((str(e.key()), e)
+                     for e in db.get([k for k in keys
+                                      if writes[str(k)] != WRITE_DELETED])
+                     if e is not None)
+        if not order:
+            return self._overlay(entities, writes, fresh, match, add)
+        entities = list(entities)
+        if add and len(entities) >= page_size:
+            oldest = min(getattr(e, order) for e in entities)
+            inside = match
+            match = lambda e: (getattr(e, order) >= oldest and
+                               (inside is None or inside(e)))
+        return sorted(self._overlay(entities, writes, fresh, match, add),
+                      key=lambda e: getattr(e, order), reverse=True)
+
+    def _overlay(self, entities, writes, fresh, match, add):
+        # Lazy so that unordered listings can stream straight from a query.
+        for e in entities:
+            key = str(e.key())
+            if key not in writes:
+                yield e
+            elif key in fresh:
+                yield fresh.pop(key)
+        if add:
+            for key, e in fresh.iteritems():
+                if writes[key] == WRITE_CREATED and (match is None or
+                                                     match(e)):
+                    yield e
+
 # Function for redirecting to /blog###########################################
 
 
@@ -95,25 +352,27 @@ def render_comment(response, comment):
 # Functions used for login username and password #############################
 
 
-def make_salt(length=5):
-    return ''.join(random.choice(letters) for x in xrange(length))
-
-
-def make_pw_hash(name, pw, salt=None):
-    if not salt:
-        salt = make_salt()
-    h = hashlib.sha256(name + pw + salt).hexdigest()
-    return '%s,%s' % (salt, h)
+def make_pw_hash(name, pw):
+    return passwords.make_hash(pw)
 
 
 def valid_pw(name, password, h):
-    salt = h.split(',')[0]
-    return h == make_pw_hash(name, password, salt)
+    return passwords.verify(name, password, h)
 
 
 def users_key(group='default'):
     return db.Key.from_path('users', group)
 
+
+# Users are cached by id as encoded protobufs, so each request decodes its
+# own copy. User.put clears both tiers; other instances' local copies can
+# lag an update by at most USER_LOCAL_TTL seconds.
+USER_LOCAL_TTL = 60
+USER_SHARED_TTL = 60 * 60
+
+user_cache = TieredCache(LRUCache(capacity=1000, ttl=USER_LOCAL_TTL),
+                         memcache, prefix='user:', ttl=USER_SHARED_TTL)
+
 # Model for the User table in Gql. Stores name, pw_hash, email################
 
 
@@ -124,32 +383,78 @@ class User(db.Model):
 
     @classmethod
     def by_id(cls, uid):
-        return User.get_by_id(uid, parent=users_key())
+        data = user_cache.get(uid)
+        if data is not None:
+            return db.model_from_protobuf(entity_pb.EntityProto(data))
+        u = User.get_by_id(uid, parent=users_key())
+        if u:
+            user_cache.set(uid, db.model_to_protobuf(u).Encode())
+        return u
+
+    def put(self, **kwargs):
+        key = super(User, self).put(**kwargs)
+        user_cache.delete(key.id())
+        return key
 
     @classmethod
     def by_name(cls, name):
-        u = User.all().filter('name =', name).get()
-        return u
+        if not name:
+            return None
+        reserved = Username.get_by_key_name(name)
+        return reserved and cls.by_id(reserved.uid)
 
     @classmethod
     def register(cls, name, pw, email=None):
-        pw_hash = make_pw_hash(name, pw)
-        return User(parent=users_key(),
-                    name=name,
-                    pw_hash=pw_hash,
-                    email=email)
+        # Reserves the name and creates the user in one cross-group
+        # transaction. Returns None if someone else already holds the name.
+        uid = db.allocate_ids(db.Key.from_path('User', 1,
+                                               parent=users_key()), 1)[0]
+        u = User(key=db.Key.from_path('User', uid, parent=users_key()),
+                 name=name,
+                 pw_hash=make_pw_hash(name, pw),
+                 email=email)
+
+        def txn():
+            if Username.get_by_key_name(name):
+                return None
+            db.put([Username(key_name=name, uid=uid), u])
+            return u
+
+        options = db.create_transaction_options(xg=True)
+        return db.run_in_transaction_options(options, txn)
 
     @classmethod
     def login(cls, name, pw):
         u = cls.by_name(name)
         if u and valid_pw(name, pw, u.pw_hash):
+            # Upgrade hashes from older formats or work factors while the
+            # plain password is at hand.
+            if passwords.needs_rehash(u.pw_hash):
+                u.pw_hash = make_pw_hash(name, pw)
+                u.put()
             return u
 
 
+# Key name is the username, so a lookup is one strongly consistent get and a
+# name can be reserved by only one account.
+class Username(db.Model):
+    uid = db.IntegerProperty(required=True)
+
+
 def blog_key(name='default'):
+    # Parent of every post written before posts became root entities. Only
+    # read now, until migrate_legacy_posts has moved them all.
     return db.Key.from_path('blogs', name)
 
 
+def post_keys(post_id):
+    # Each post is its own entity group, so writes to different posts never
+    # contend. Legacy posts keep their id under the shared blog_key() until
+    # migrate_legacy_posts reserves it and moves them.
+    return [db.Key.from_path('Post', int(post_id)),
+            db.Key.from_path('Post', int(post_id), parent=blog_key())]
+
+
 # Defines the contents of a post #############################################
 
 
@@ -159,16 +464,627 @@ class Post(db.Model):
     created = db.DateTimeProperty(auto_now_add=True)
     last_modified = db.DateTimeProperty(auto_now=True)
     author = db.StringProperty(required=True)
-    likes = db.IntegerProperty(required=True)
-    likers = db.StringProperty(required=True)
+    # None for posts written before comments were counted
+    comment_count = db.IntegerProperty()
+    # Body HTML rendered from content when the post is written
+    rendered_html = db.TextProperty()
+    render_version = db.IntegerProperty(default=0)
+    # When the newest comment was added; kept when comments are deleted
+    last_comment_at = db.DateTimeProperty()
+    # Bumped on every image upload; 0 for posts without an image. Negated
+    # when the upload cannot be decoded, so the post shows no image but a
+    # later upload still never reuses a version of a cached image URL.
+    image_version = db.IntegerProperty(default=0)
+    # Widths of the thumbnails made for image_version, empty until ready
+    image_widths = db.ListProperty(int, indexed=False)
 
-    def render(self):
-        self._render_text = self.content.replace('\n', '<br>')
+    @classmethod
+    def by_id(cls, post_id):
+        post, legacy = db.get(post_keys(post_id))
+        return post or legacy
+
+    @classmethod
+    def by_id_with(cls, post_id, *keys):
+        # The post and any other `keys` in one batch get, as
+        # (post, [entity, ...])
+        found = db.get(post_keys(post_id) + list(keys))
+        return found[0] or found[1], found[2:]
+
+    @classmethod
+    def by_id_async(cls, post_id):
+        # Starts the get without waiting on it. Calling the result blocks
+        # for the post.
+        rpc = db.get_async(post_keys(post_id))
+
+        def result():
+            post, legacy = rpc.get_result()
+            return post or legacy
+        return result
+
+    @classmethod
+    def get_multi(cls, post_ids):
+        # Posts for `post_ids` in order, with one batch get. Missing posts
+        # are left out.
+        keys = []
+        for pid in post_ids:
+            keys.extend(post_keys(pid))
+        found = db.get(keys)
+        return [root or legacy for root, legacy in zip(found[::2], found[1::2])
+                if root or legacy]
+
+    def image_url(self, width=0):
+        # Width 0 is the uploaded original
+        return '/image/%d/%d/%d' % (self.key().id(), self.image_version,
+                                    width)
+
+    def render_key(self):
+        return 'post_html:%s:%s:%s:%d' % (RENDER_KEY_VERSION, self.key().id(),
+                                           self.last_modified.isoformat(),
+                                           self.like_count)
+
+    def render_body(self):
+        self.rendered_html = markup.render(self.content)
+        self.render_version = markup.RENDER_VERSION
+
+    def body_html(self):
+        # Posts stored under an older RENDER_VERSION are rendered on the fly
+        # until the re-render job reaches them.
+        if self.render_version != markup.RENDER_VERSION:
+            return markup.render(self.content)
+        return self.rendered_html
+
+    def _render(self):
         return render_str("post.html", p=self)
 
-    @property
-    def comments(self):
-        return Comment.all().filter("post = ", str(self.key().id()))
+    def render(self):
+        return Post.render_multi([self])[0]
+
+    @classmethod
+    def load_like_counts(cls, posts):
+        posts = [p for p in posts if not hasattr(p, 'like_count')]
+        counts = like_counts([p.key().id() for p in posts])
+        for p in posts:
+            p.like_count = counts[p.key().id()]
+
+    @classmethod
+    def render_multi(cls, posts):
+        # Rendered fragments are keyed on last_modified and the like count,
+        # so a change simply misses the cache and stale entries age out.
+        cls.load_like_counts(posts)
+        keys = [p.render_key() for p in posts]
+        cached = memcache.get_multi(keys)
+        fresh = {}
+        rendered = []
+        for key, p in zip(keys, posts):
+            html = cached.get(key)
+            if html is None:
+                html = fresh[key] = p._render()
+            rendered.append(html)
+        if fresh:
+            memcache.set_multi(fresh, time=RENDER_CACHE_TTL)
+        return rendered
+
+    @classmethod
+    def run_comments(cls, post_id, limit=MAX_COMMENTS):
+        # The query is sent as soon as run() is called; reading the
+        # iterator waits for it.
+        return Comment.all().filter("post = ", str(post_id)).run(
+            limit=limit, batch_size=limit)
+
+    @classmethod
+    def change_comment(cls, post_key, added=None, removed=None, job=None):
+        # Puts `added` or deletes `removed` together with the stored comment
+        # count and last comment time of the post in one cross-group
+        # transaction. `job` is called with the comment inside it, to add a
+        # transactional job that only runs if the change commits.
+        def txn():
+            post = post_key and db.get(post_key)
+            if post is not None and post.comment_count is not None:
+                post.comment_count += 1 if added else -1
+            if post is not None and added:
+                post.last_comment_at = added.created
+            if added:
+                db.put([added] + ([post] if post else []))
+            else:
+                db.delete(removed)
+                if post:
+                    post.put()
+            if job:
+                job(added or removed)
+            return post
+
+        options = db.create_transaction_options(xg=True)
+        return db.run_in_transaction_options(options, txn)
+
+    @classmethod
+    def edit(cls, post_key, author, job=None, xg=False, **changes):
+        # Applies `changes` inside a transaction on the post's own entity
+        # group, so concurrent edits cannot overwrite each other. Returns
+        # None unless `author` wrote the post. `job` is called with the post
+        # inside the transaction, as in change_comment; pass xg=True when it
+        # writes to other entity groups.
+        def txn():
+            post = db.get(post_key)
+            if post is None or post.author != author:
+                return None
+            for name, value in changes.iteritems():
+                setattr(post, name, value)
+            post.render_body()
+            post.put()
+            if job:
+                job(post)
+            return post
+
+        options = db.create_transaction_options(xg=xg)
+        return db.run_in_transaction_options(options, txn)
+
+# Image attachments ##########################################################
+
+# Uploads are stored in one entity each, so they must fit in one
+MAX_IMAGE_BYTES = 900 * 1024
+IMAGE_TYPES = ('image/jpeg', 'image/png', 'image/gif')
+
+# Thumbnail widths made for every image, and their JPEG quality
+IMAGE_WIDTHS = (320, 640, 1280)
+IMAGE_QUALITY = 85
+
+# Image URLs include the version, so their content never changes
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+class PostImage(db.Model):
+    # Key name is "<post id>:<image version>:<width>"; width 0 is the
+    # original upload.
+    post_id = db.IntegerProperty(required=True)
+    content_type = db.StringProperty(required=True, indexed=False)
+    data = db.BlobProperty(required=True)
+
+    @classmethod
+    def key_name_for(cls, post_id, version, width):
+        return '%d:%d:%d' % (post_id, version, width)
+
+
+def uploaded_image(request):
+    # Returns (data, content type) for the form's image field, or None when
+    # no file was chosen. Raises ValueError for files that are not accepted.
+    upload = request.POST.get('image')
+    if not hasattr(upload, 'file'):
+        return None
+    data = upload.file.read(MAX_IMAGE_BYTES + 1)
+    if not data:
+        return None
+    if upload.type not in IMAGE_TYPES:
+        raise ValueError('Images must be JPEG, PNG or GIF.')
+    if len(data) > MAX_IMAGE_BYTES:
+        raise ValueError('Images must be smaller than %d KB.' %
+                         (MAX_IMAGE_BYTES // 1024))
+    return data, upload.type
+
+
+def attach_image(post, data, content_type):
+    # Stores the original for post.image_version. Thumbnails are made by a
+    # task so the upload request never decodes the image. Called inside the
+    # cross-group transaction that writes the post, so the post never
+    # waits on an image or a task that was not stored.
+    post_id = post.key().id()
+    PostImage(key_name=PostImage.key_name_for(post_id, post.image_version, 0),
+              post_id=post_id, content_type=content_type,
+              data=db.Blob(data)).put()
+    jobs.enqueue(make_thumbnails, post_id, post.image_version,
+                 _transactional=True)
+
+
+def drop_image(post_key, version):
+    # Removes image `version` from its post, so the page stops waiting for
+    # thumbnails that will never be made
+    def txn():
+        post = db.get(post_key)
+        if post is not None and post.image_version == version:
+            post.image_version = -version
+            post.image_widths = []
+            post.put()
+
+    db.run_in_transaction(txn)
+    db.delete(db.Key.from_path(PostImage.kind(), PostImage.key_name_for(
+        post_key.id(), version, 0)))
+
+
+def make_thumbnails(post_id, version):
+    from PIL import Image
+    post = Post.by_id(post_id)
+    if post is None or post.image_version != version:
+        # Deleted, or replaced by a newer upload with its own task
+        return
+    original = PostImage.get_by_key_name(
+        PostImage.key_name_for(post_id, version, 0))
+    try:
+        img = Image.open(StringIO(original.data))
+        img.load()
+    except IOError:
+        drop_image(post.key(), version)
+        raise jobs.PermanentFailure(
+            'post %d image %d cannot be decoded' % (post_id, version))
+    if img.mode in ('RGBA', 'LA', 'P'):
+        # JPEG has no transparency, so flatten onto white
+        img = img.convert('RGBA')
+        flat = Image.new('RGB', img.size, (255, 255, 255))
+        flat.paste(img, mask=img.split()[-1])
+        img = flat
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+    thumbs = []
+    widths = []
+    for width in IMAGE_WIDTHS:
+        width = min(width, img.size[0])
+        if width in widths:
+            continue
+        height = max(1, img.size[1] * width // img.size[0])
+        out = StringIO()
+        img.resize((width, height), Image.ANTIALIAS).save(
+            out, 'JPEG', quality=IMAGE_QUALITY, optimize=True)
+        thumbs.append(PostImage(
+            key_name=PostImage.key_name_for(post_id, version, width),
+            post_id=post_id, content_type='image/jpeg',
+            data=db.Blob(out.getvalue())))
+        widths.append(width)
+    db.put(thumbs)
+
+    def txn():
+        current = db.get(post.key())
+        if current is not None and current.image_version == version:
+            current.image_widths = widths
+            current.put()
+
+    db.run_in_transaction(txn)
+    # Earlier versions are no longer linked from any page
+    prefix = '%d:%d:' % (post_id, version)
+    db.delete([k for k in PostImage.all(keys_only=True).filter(
+        'post_id =', post_id) if not k.name().startswith(prefix)])
+
+# Likes ######################################################################
+
+# Counter shards per post. Each like writes to one random shard so that
+# concurrent likes on a popular post rarely touch the same entity.
+LIKE_SHARDS = 20
+
+# Seconds a summed like count stays in memcache
+LIKE_COUNT_TTL = 10 * 60
+
+# Seconds after a like changes during which no reader may cache a count.
+# A reader that summed the shards before the change cannot then store its
+# stale total.
+LIKE_COUNT_LOCK = 5
+
+
+class Like(db.Model):
+    post_id = db.IntegerProperty(required=True)
+    user_id = db.IntegerProperty(required=True)
+
+    @classmethod
+    def key_for(cls, post_id, user_id):
+        return db.Key.from_path(cls.kind(), '%d:%d' % (post_id, user_id))
+
+
+class LikeShard(db.Model):
+    count = db.IntegerProperty(default=0)
+
+    @classmethod
+    def keys_for(cls, post_id):
+        return [db.Key.from_path(cls.kind(), '%d:%d' % (post_id, i))
+                for i in xrange(LIKE_SHARDS)]
+
+
+def like_count_key(post_id):
+    return 'likes:%d' % post_id
+
+
+def like_counts(post_ids):
+    # Returns {post_id: likes}, summing shards only for memcache misses.
+    # Counts are only ever added, so they lose to toggle_like's lock.
+    cached = memcache.get_multi([like_count_key(pid) for pid in post_ids])
+    counts = {}
+    missing = []
+    for pid in post_ids:
+        count = cached.get(like_count_key(pid))
+        if count is None:
+            missing.append(pid)
+        else:
+            counts[pid] = count
+    if missing:
+        shard_keys = []
+        for pid in missing:
+            shard_keys.extend(LikeShard.keys_for(pid))
+        shards = db.get(shard_keys)
+        fresh = {}
+        for i, pid in enumerate(missing):
+            batch = shards[i * LIKE_SHARDS:(i + 1) * LIKE_SHARDS]
+            counts[pid] = sum(s.count for s in batch if s)
+            fresh[like_count_key(pid)] = counts[pid]
+        memcache.add_multi(fresh, time=LIKE_COUNT_TTL)
+    return counts
+
+
+def toggle_like(post_id, user_id):
+    # Likes or unlikes a post for a user and returns True if it is now
+    # liked. The Like entity and one counter shard change together in a
+    # cross-group transaction, so membership and count never disagree.
+    like_key = Like.key_for(post_id, user_id)
+    shard_key = random.choice(LikeShard.keys_for(post_id))
+
+    def txn():
+        like, shard = db.get([like_key, shard_key])
+        if shard is None:
+            shard = LikeShard(key=shard_key)
+        if like is None:
+            shard.count += 1
+            db.put([Like(key=like_key, post_id=post_id, user_id=user_id),
+                    shard])
+            return True
+        shard.count -= 1
+        db.delete(like)
+        shard.put()
+        return False
+
+    options = db.create_transaction_options(xg=True)
+    liked = db.run_in_transaction_options(options, txn)
+    memcache.delete(like_count_key(post_id), seconds=LIKE_COUNT_LOCK)
+    return liked
+
+# Follows and home timelines #################################################
+
+# Posts kept in each user's timeline, newest first
+TIMELINE_SIZE = 100
+
+# Posts shown on /home
+HOME_SIZE = PAGE_SIZE
+
+# Authors with more followers than this are not fanned out on write. Their
+# followers' /home pages query their newest posts instead.
+FANOUT_LIMIT = 1000
+
+# Timelines updated per fan-out task
+FANOUT_BATCH = 100
+
+# Seconds a user's list of followed fan-out-on-read authors stays in
+# memcache. Following or unfollowing clears it.
+PULL_AUTHORS_TTL = 10 * 60
+
+
+class Follow(db.Model):
+    follower = db.IntegerProperty(required=True)
+    followee = db.StringProperty(required=True)
+    created = db.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def key_for(cls, user_id, author):
+        return db.Key.from_path(cls.kind(), '%d:%s' % (user_id, author))
+
+
+class FollowStats(db.Model):
+    # Key name is the followed author's name
+    followers = db.IntegerProperty(default=0)
+
+
+class Timeline(db.Model):
+    # Key name is the user id. The two lists run in parallel.
+    post_ids = db.ListProperty(int, indexed=False)
+    created = db.ListProperty(datetime.datetime, indexed=False)
+
+    @classmethod
+    def key_for(cls, user_id):
+        return db.Key.from_path(cls.kind(), str(user_id))
+
+    def merge(self, posts):
+        # Adds `posts` that are not already here, keeping the newest
+        # TIMELINE_SIZE. Merging the same posts again changes nothing, so
+        # fan-out tasks can be retried.
+        known = set(self.post_ids)
+        entries = zip(self.created, self.post_ids)
+        entries.extend((p.created, p.key().id()) for p in posts
+                       if p.key().id() not in known)
+        entries.sort(reverse=True)
+        del entries[TIMELINE_SIZE:]
+        self.created = [c for c, _ in entries]
+        self.post_ids = [pid for _, pid in entries]
+
+
+def merge_timelines(user_ids, posts):
+    # One batch get and put for every timeline. Not transactional: two
+    # tasks racing on one timeline can drop an entry, which only costs a
+    # line on /home.
+    keys = [Timeline.key_for(uid) for uid in user_ids]
+    timelines = [t or Timeline(key=k) for t, k in zip(db.get(keys), keys)]
+    for t in timelines:
+        t.merge(posts)
+    db.put(timelines)
+
+
+def toggle_follow(user_id, author):
+    # Follows or unfollows `author` and returns True if now following. The
+    # Follow entity and the author's follower count change together.
+    follow_key = Follow.key_for(user_id, author)
+    stats_key = db.Key.from_path(FollowStats.kind(), author)
+
+    def txn():
+        follow, stats = db.get([follow_key, stats_key])
+        if stats is None:
+            stats = FollowStats(key=stats_key)
+        if follow is None:
+            stats.followers += 1
+            db.put([Follow(key=follow_key, follower=user_id,
+                           followee=author), stats])
+            return True
+        stats.followers -= 1
+        db.delete(follow)
+        stats.put()
+        return False
+
+    options = db.create_transaction_options(xg=True)
+    return db.run_in_transaction_options(options, txn)
+
+
+def pull_authors_key(user_id):
+    return 'pull_authors:%d' % user_id
+
+
+def pull_authors(user_id):
+    # Names of the authors `user_id` follows whose posts are fanned out on
+    # read. Built from the user's own follows, with a keys-only query and
+    # one batch get of their FollowStats.
+    names = memcache.get(pull_authors_key(user_id))
+    if names is None:
+        query = Follow.all(keys_only=True).filter('follower =', user_id)
+        # Follow key names are "<follower id>:<author>"
+        followed = [k.name().split(':', 1)[1] for k in query.run()]
+        stats = db.get([db.Key.from_path(FollowStats.kind(), name)
+                        for name in followed])
+        names = [name for name, s in zip(followed, stats)
+                 if s and s.followers > FANOUT_LIMIT]
+        memcache.set(pull_authors_key(user_id), names, time=PULL_AUTHORS_TTL)
+    return names
+
+
+# Jobs keeping timelines up to date
+
+def fan_out_post(post_id, author_id, cursor=None):
+    post = Post.by_id(post_id)
+    if post is None:
+        return
+    if cursor is None:
+        merge_timelines([author_id], [post])
+        stats = FollowStats.get_by_key_name(post.author)
+        if stats and stats.followers > FANOUT_LIMIT:
+            return
+    query = Follow.all().filter('followee =', post.author)
+    follows, cursor = fetch_page(query, cursor, FANOUT_BATCH)
+    if follows:
+        merge_timelines([f.follower for f in follows], [post])
+    if cursor:
+        jobs.enqueue(fan_out_post, post_id, author_id, cursor=cursor)
+
+
+def backfill_timeline(user_id, author):
+    # Brings an author's recent posts into a new follower's timeline
+    posts = Post.all().filter('author =', author).order(
+        '-created').fetch(TIMELINE_SIZE)
+    merge_timelines([user_id], posts)
+
+
+def prune_timeline(user_id, author):
+    # Drops an unfollowed author's posts, and deleted posts along the way
+    timeline = Timeline.get(Timeline.key_for(user_id))
+    if timeline is None:
+        return
+    posts = [p for p in Post.get_multi(timeline.post_ids)
+             if p.author != author]
+    timeline.post_ids = []
+    timeline.created = []
+    timeline.merge(posts)
+    timeline.put()
+
+# Search index maintenance ###################################################
+
+
+def index_post(post):
+    # Subject words count three times as much as body words
+    search.index_document('Post:%d' % post.key().id(), post.key().id(),
+                          [(post.subject, 3), (post.content, 1)])
+
+
+def comment_doc_id(comment):
+    # Comment ids are only unique under their author, so include both
+    return 'Comment:%d:%d' % (comment.parent_key().id(), comment.key().id())
+
+
+def index_comment(comment):
+    search.index_document(comment_doc_id(comment), int(comment.post),
+                          [(comment.comment, 1)])
+
+# Background jobs for post and comment writes ###############################
+
+# Entities deleted per run of a cascade delete, and posts per recount run
+CASCADE_BATCH = 200
+RECOUNT_BATCH = 20
+
+
+def post_saved(post_id, author_id=None):
+    # Runs after a post is created (author_id given) or edited
+    post = Post.by_id(post_id)
+    if post is None:
+        return
+    index_post(post)
+    invalidate_feeds(post.author)
+    if author_id is not None:
+        fan_out_post(post_id, author_id)
+
+
+def post_deleted(post_id, author):
+    search.unindex_post(post_id)
+    invalidate_feeds(author)
+    memcache.delete_multi([RECENT_COMMENTS_KEY, like_count_key(post_id)])
+    db.delete(LikeShard.keys_for(post_id))
+    delete_post_children(post_id)
+
+
+def delete_post_children(post_id):
+    # Comments, likes and images only refer to their post by id, so they
+    # are deleted here in batches, running again until none are left.
+    # Deleting a key twice is harmless, so retries are too.
+    keys = []
+    for query in [Comment.all(keys_only=True).filter('post =', str(post_id)),
+                  Like.all(keys_only=True).filter('post_id =', post_id),
+                  PostImage.all(keys_only=True).filter('post_id =',
+                                                       post_id)]:
+        keys.extend(query.fetch(CASCADE_BATCH))
+    if keys:
+        db.delete(keys)
+        jobs.enqueue(delete_post_children, post_id)
+
+
+def comment_saved(comment_key, edited=False):
+    comment = Comment.get(comment_key)
+    if comment is None:
+        return
+    index_comment(comment)
+    if edited:
+        memcache.delete(RECENT_COMMENTS_KEY)
+    else:
+        push_recent_comment(comment)
+
+
+def comment_deleted(doc_id):
+    search.unindex_document(doc_id)
+    memcache.delete(RECENT_COMMENTS_KEY)
+
+
+def recount_comments(post_key):
+    # Recomputes a post's comment_count and last_comment_at from its
+    # comments. Also gives legacy posts a count.
+    query = Comment.all().filter('post =', str(post_key.id()))
+    count = query.count(limit=MAX_COUNT)
+    # Served by the (post, -created) composite index in index.yaml
+    newest = query.order('-created').get()
+
+    def txn():
+        post = db.get(post_key)
+        if post is not None:
+            post.comment_count = count
+            post.last_comment_at = newest and newest.created
+            post.put()
+
+    db.run_in_transaction(txn)
+
+
+def recount_batch(cursor=None):
+    # Recounts comments and drops cached like counts for one batch of
+    # posts, then queues the next batch.
+    query = Post.all(keys_only=True)
+    keys, cursor = fetch_page(query, cursor, RECOUNT_BATCH)
+    for key in keys:
+        recount_comments(key)
+    memcache.delete_multi([like_count_key(k.id()) for k in keys])
+    if cursor:
+        jobs.enqueue(recount_batch, cursor)
 
 # Handler for blog homepage ###################################################
 
@@ -176,8 +1092,14 @@ class Post(db.Model):
 class BlogFront(BlogHandler):
 
     def get(self):
-        posts = db.GqlQuery("select * from Post order by created desc")
-        self.render('front.html', posts=posts)
+        start = self.request.get('cursor')
+        posts, cursor = fetch_page(Post.all().order('-created'), start)
+        posts = self.merge_recent(posts, 'Post', add=not start,
+                                  order='created')
+        Post.load_like_counts(posts)
+        if self.not_modified([p.render_key() for p in posts] + [cursor]):
+            return
+        self.stream('front.html', posts=iter_rendered(posts), cursor=cursor)
 
 # Handler for retrieving a post ##############################################
 
@@ -185,18 +1107,26 @@ class BlogFront(BlogHandler):
 class PostPage(BlogHandler):
 
     def get(self, post_id):
-        p = self
-        key = db.Key.from_path('Post', int(post_id), parent=blog_key())
-        post = db.get(key)
+        post = Post.by_id(post_id)
         if not post:
             self.error(404)
             return
-        self.render("permalink.html", post=post)
+        Post.load_like_counts([post])
+        following = None
+        if self.user and self.user.name != post.author:
+            following = Follow.get(Follow.key_for(self.user.key().id(),
+                                                  post.author)) is not None
+        if self.not_modified([post.render_key(), following]):
+            return
+        self.render("permalink.html", post=post, following=following)
 
 # Handler for registering a new post##########################################
 
 
 class NewPost(BlogHandler):
+    rate_limits = {'POST': ratelimit.RateLimiter(rate=1 / 60.0, burst=5,
+                                                 prefix='newpost:')}
+
     def get(self):
         if self.user:
             self.render("newpost.html")
@@ -210,11 +1140,29 @@ class NewPost(BlogHandler):
             return
         subject = self.request.get('subject')
         content = self.request.get('content')
-        author = self.request.get('author')
+        try:
+            image = uploaded_image(self.request)
+        except ValueError as e:
+            self.render("newpost.html", subject=subject, content=content,
+                        error=str(e))
+            return
         if subject and content:
-            p = Post(parent=blog_key(), subject=subject, content=content,
-                     author=author, likes=0, likers="none")
-            p.put()
+            p = Post(subject=subject, content=content, author=self.user.name,
+                     comment_count=0, image_version=1 if image else 0)
+            p.render_body()
+            author_id = self.user.key().id()
+
+            def txn():
+                p.put()
+                jobs.enqueue(post_saved, p.key().id(), author_id,
+                             _transactional=True)
+                if image:
+                    attach_image(p, *image)
+
+            # The image is its own entity group
+            options = db.create_transaction_options(xg=bool(image))
+            db.run_in_transaction_options(options, txn)
+            self.record_write(p.key(), created=True)
             self.redirect('/post/%s' % str(p.key().id()))
             return
         else:
@@ -280,17 +1228,26 @@ class Signup(BlogHandler):
 
 
 class Register(Signup):
+    # Signups come from signed-out clients spread over every instance, so
+    # this budget is also counted in memcache. Only signups that go on to
+    # create an account spend from it, so a few typos behind a shared
+    # address cannot lock everyone there out.
+    signup_limit = ratelimit.RateLimiter(rate=1 / 600.0, burst=3,
+                                         shared=memcache, prefix='register:')
 
     def done(self):
-        u = User.by_name(self.username)
-        if u:
-            msg = 'That user already exists.'
-            self.render('signup-form.html', error_username=msg)
-        else:
+        taken = User.by_name(self.username)
+        if not taken and not self.spend(self.signup_limit):
+            return
+        u = None
+        if not taken:
             u = User.register(self.username, self.password, self.email)
-            u.put()
+        if u:
             self.login(u)
             self.redirect('/blog')
+        else:
+            msg = 'That user already exists.'
+            self.render('signup-form.html', error_username=msg)
 
 # Handler for login requests #################################################
 
@@ -340,23 +1297,103 @@ class Welcome(BlogHandler):
 class MyPosts(BlogHandler):
 
     def get(self):
+        if not self.user:
+            self.redirect('/login')
+            return
         username = self.user.name
-        posts = db.GqlQuery("SELECT * FROM Post where author = :author",
-                            author=username)
-        self.render('myposts.html', username=username, posts=posts)
+        start = self.request.get('cursor')
+        # Served by the (author, -created) composite index in index.yaml
+        query = Post.all().filter('author =', username).order('-created')
+        posts, cursor = fetch_page(query, start)
+        posts = self.merge_recent(posts, 'Post',
+                                  match=lambda p: p.author == username,
+                                  add=not start, order='created')
+        total = Post.all(keys_only=True).filter(
+            'author =', username).count(limit=MAX_COUNT)
+        self.stream('myposts.html', username=username, total=total,
+                    posts=iter_rendered(posts), cursor=cursor)
+
+# Handlers for following authors and the home timeline #######################
+
+
+class FollowAuthor(BlogHandler):
+    rate_limits = {'POST': ratelimit.RateLimiter(rate=0.5, burst=20,
+                                                 prefix='follow:')}
+
+    def post(self, author):
+        if not self.user:
+            self.redirect('/login')
+            return
+        if author == self.user.name or not User.by_name(author):
+            self.render('error.html')
+            return
+        uid = self.user.key().id()
+        following = toggle_follow(uid, author)
+        memcache.delete(pull_authors_key(uid))
+        if following:
+            jobs.enqueue(backfill_timeline, uid, author)
+        else:
+            jobs.enqueue(prune_timeline, uid, author)
+        self.redirect(self.request.referer or '/home')
+
+
+class Home(BlogHandler):
+
+    def get(self):
+        if not self.user:
+            self.redirect('/login')
+            return
+        uid = self.user.key().id()
+        # The timeline get and the newest-posts query of every followed
+        # fan-out-on-read author are all in flight before any is read
+        pending = db.get_async(Timeline.key_for(uid))
+        runs = [Post.all().filter('author =', a).order('-created').run(
+            limit=HOME_SIZE, batch_size=HOME_SIZE)
+            for a in pull_authors(uid)]
+        timeline = pending.get_result()
+        posts = Post.get_multi(timeline.post_ids[:HOME_SIZE]
+                               if timeline else [])
+        seen = set(p.key().id() for p in posts)
+        for run in runs:
+            posts.extend(p for p in run if p.key().id() not in seen)
+        posts.sort(key=lambda p: p.created, reverse=True)
+        posts = self.merge_recent(posts, 'Post',
+                                  match=lambda p: p.author == self.user.name,
+                                  order='created', page_size=HOME_SIZE)
+        posts = list(posts)[:HOME_SIZE]
+        Post.load_like_counts(posts)
+        self.stream('home.html', posts=iter_rendered(posts))
+
+# Handler for serving post images ############################################
+
+
+class ImageFile(BlogHandler):
+
+    def get(self, post_id, version, width):
+        image = PostImage.get_by_key_name(
+            PostImage.key_name_for(int(post_id), int(version), int(width)))
+        if image is None:
+            self.error(404)
+            return
+        headers = self.response.headers
+        headers['Content-Type'] = str(image.content_type)
+        # Originals are served with the type the uploader declared
+        headers['X-Content-Type-Options'] = 'nosniff'
+        headers['Cache-Control'] = 'public, max-age=%d' % IMAGE_MAX_AGE
+        self.write(image.data)
 
 # Handler for deleting a post#################################################
 
 
 class DeletePost(BlogHandler):
+    rate_limits = {'POST': None}
 
     def get(self, post_id):
         if not self.user:
             self.redirect('/login')
             return
         else:
-            key = db.Key.from_path('Post', int(post_id), parent=blog_key())
-            post = db.get(key)
+            post = Post.by_id(post_id)
             if post is not None:
                 if self.user.name == post.author:
                     self.render('deletepost.html')
@@ -368,12 +1405,16 @@ class DeletePost(BlogHandler):
             self.redirect('/login')
             return
         else:
-            key = db.Key.from_path('Post', int(post_id), parent=blog_key())
-            post = db.get(key)
+            post = Post.by_id(post_id)
             if post and self.user.name == post.author:
                 if self.user.name == post.author:
-                    db.delete(key)
-                    time.sleep(0.1)
+                    def txn():
+                        db.delete(post)
+                        jobs.enqueue(post_deleted, post.key().id(),
+                                     post.author, _transactional=True)
+
+                    db.run_in_transaction(txn)
+                    self.record_write(post.key(), deleted=True)
                     self.redirect('/blog')
                     return
                 else:
@@ -385,44 +1426,19 @@ class DeletePost(BlogHandler):
 
 
 class LikePost(BlogHandler):
+    rate_limits = {'GET': ratelimit.RateLimiter(rate=0.5, burst=10,
+                                                prefix='like:')}
 
     def get(self, post_id):
-        key = db.Key.from_path('Post', int(post_id), parent=blog_key())
-        post = db.get(key)
         if not self.user:
             self.redirect('/login')
             return
-        else:
-            if post is None:
-                self.render('error.html')
-            else:
-                liker = self.user.name
-                if liker != post.author:
-                    if liker not in post.likers:
-                        post.likes += 1
-                        post.likers = post.likers + " " + liker
-                        post.put()
-                        time.sleep(0.1)
-                        self.redirect("/blog")
-                        return
-                    elif liker in post.likers:
-                        names = post.likers
-                        print names
-                        names = names.split()
-                        print names
-                        if liker in names:
-                            print names
-                            names.remove(liker)
-                            print names
-                            post.likes -= 1
-                            names = "".join(names)
-                            post.likers = names
-                            post.put()
-                            time.sleep(0.1)
-                            self.redirect("/blog")
-                            return
-                else:
-                    self.render("error.html")
+        post = Post.by_id(post_id)
+        if post is None or self.user.name == post.author:
+            self.render('error.html')
+            return
+        toggle_like(post.key().id(), self.user.key().id())
+        self.redirect("/blog")
 
 # Handler for Commenting on a post ###########################################
 
@@ -431,61 +1447,102 @@ class Comment(db.Model):
     post = db.StringProperty(required=True)
     comment = db.StringProperty(required=True)
     author = db.StringProperty(required=True)
+    created = db.DateTimeProperty(auto_now_add=True)
 
     @property
     def comments(self):
         return Comment.all().filter("post = ", str(self.key().id()))
 
 
+def comment_key(user, comment_id):
+    # Comments are stored under the User who wrote them
+    return db.Key.from_path('Comment', int(comment_id), parent=user.key())
+
+
+# Recent comments across the blog, newest first, kept in memcache
+RECENT_COMMENTS = 20
+RECENT_COMMENTS_KEY = 'recent_comments'
+
+
+def recent_comment_entry(c):
+    return {'key': str(c.key()), 'post_id': int(c.post),
+            'author': c.author, 'comment': c.comment, 'created': c.created}
+
+
+def recent_comments():
+    # One memcache get, or a single query to rebuild the feed on a miss
+    feed = memcache.get(RECENT_COMMENTS_KEY)
+    if feed is None:
+        feed = [recent_comment_entry(c) for c in
+                Comment.all().order('-created').fetch(RECENT_COMMENTS)]
+        memcache.add(RECENT_COMMENTS_KEY, feed)
+    return feed
+
+
+def push_recent_comment(c):
+    # Prepends a new comment with compare-and-set so concurrent comments
+    # are not lost. If the feed is not cached the next read rebuilds it.
+    client = memcache.Client()
+    for _ in xrange(3):
+        feed = client.gets(RECENT_COMMENTS_KEY)
+        entry = recent_comment_entry(c)
+        if feed is None or entry in feed:
+            return
+        feed = [entry] + feed[:RECENT_COMMENTS - 1]
+        if client.cas(RECENT_COMMENTS_KEY, feed):
+            return
+    memcache.delete(RECENT_COMMENTS_KEY)
+
+
+class RecentComments(BlogHandler):
+
+    def get(self):
+        self.render('recentcomments.html', comments=recent_comments())
+
+
 class NewComment(BlogHandler):
+    rate_limits = {'POST': ratelimit.RateLimiter(rate=0.2, burst=10,
+                                                 prefix='comment:')}
 
     def get(self, post_id):
-        post = Post.get_by_id(int(post_id), parent=blog_key())
         if not self.user:
-            self.redirect('/logn')
+            self.redirect('/login')
             return
-        else:
-            if post is not None:
-                subject = post.subject
-                content = post.content
-                self.render('comment.html', subject=subject, post=post,
-                            content=content, postuser=post.author, pkey=post.key())
-            else:
-                self.render('error.html')
-                return
+        # The post get and the comment query are both in flight before
+        # either result is read
+        pending = Post.by_id_async(post_id)
+        comments = Post.run_comments(post_id)
+        post = pending()
+        if post is None:
+            self.render('error.html')
+            return
+        comments = self.merge_recent(list(comments), 'Comment',
+                                     match=lambda c: c.post == post_id)
+        self.render('comment.html', subject=post.subject, post=post,
+                    content=post.content, postuser=post.author,
+                    pkey=post.key(), comments=comments)
 
     def post(self, post_id):
-        key = db.Key.from_path('Post', int(post_id), parent=blog_key())
         if not self.user:
             self.redirect('/login')
             return
-        else:
-            author = self.user.name
-            comment = db.GqlQuery("SELECT * FROM Comment WHERE post= :post and"
-                                  " author= :author", post=post_id, author=author)
-            if comment is not None:
-                post = db.get(key)
-                print post
-                if post is not None:
-                    comment = self.request.get('comment')
-                    author = self.user.name
-                    if comment:
-                        parent = self.user.key()
-                        c = Comment(post=post_id, comment=comment, parent=parent,
-                            author=author)
-                        c.put()
-                        p = post
-                        self.redirect(('/post/%s' % str(p.key().id()) + ('/comment')))
-                        return
-                    else:
-                        self.render('error.html')
-            else:
-                self.render('error.html')
+        post = Post.by_id(post_id)
+        comment = self.request.get('comment')
+        if post is None or not comment:
+            self.render('error.html')
+            return
+        c = Comment(post=post_id, comment=comment, parent=self.user.key(),
+                    author=self.user.name)
+        Post.change_comment(post.key(), added=c, job=lambda c: jobs.enqueue(
+            comment_saved, str(c.key()), _transactional=True))
+        self.record_write(c.key(), created=True)
+        self.redirect('/post/%s/comment' % post.key().id())
 
 # Handler for deleting a comment #############################################
 
 
 class DeleteComment(BlogHandler):
+    rate_limits = {'GET': None}
 
     def get(self, post_id, comment_id):
         if not self.user:
@@ -495,8 +1552,13 @@ class DeleteComment(BlogHandler):
                                         parent=self.user.key())
             if comment is not None:
                 if self.user.name == comment.author:
-                    db.delete(comment)
-                    time.sleep(0.1)
+                    post = Post.by_id(comment.post)
+                    Post.change_comment(
+                        post and post.key(), removed=comment,
+                        job=lambda c: jobs.enqueue(
+                            comment_deleted, comment_doc_id(c),
+                            _transactional=True))
+                    self.record_write(comment.key(), deleted=True)
                     self.redirect('/blog')
                     return
                 else:
@@ -508,13 +1570,14 @@ class DeleteComment(BlogHandler):
 
 
 class EditPost(BlogHandler):
+    rate_limits = {'POST': None}
 
     def get(self, post_id):
         if not self.user:
             self.redirect("/login")
             return
         else:
-            post = Post.get_by_id(int(post_id), parent=blog_key())
+            post = Post.by_id(post_id)
             if post is not None:
                 if self.user.name == post.author:
                     content = Post.content
@@ -529,19 +1592,33 @@ class EditPost(BlogHandler):
                 self.render('error.html')
 
     def post(self, post_id):
-        post = Post.get_by_id(int(post_id), parent=blog_key())
+        post = Post.by_id(post_id)
         if post is not None:
             if not self.user:
                 self.redirect('/login')
             else:
-                if self.user.name != post.author:
+                try:
+                    image = uploaded_image(self.request)
+                except ValueError as e:
+                    self.render("editpost.html", post=post, error=str(e))
+                    return
+                changes = {'content': self.request.get('content')}
+                if image:
+                    changes.update(image_version=abs(post.image_version) + 1,
+                                   image_widths=[])
+
+                def job(p):
+                    jobs.enqueue(post_saved, p.key().id(),
+                                 _transactional=True)
+                    if image:
+                        attach_image(p, *image)
+
+                p = Post.edit(post.key(), self.user.name, job=job,
+                              xg=bool(image), **changes)
+                if p is None:
                     self.render("error.html")
                 else:
-                    key = db.Key.from_path('Post', int(post_id), parent=blog_key())
-                    p = db.get(key)
-                    p.content = self.request.get('content')
-                    p.put()
-                    time.sleep(0.1)
+                    self.record_write(p.key())
                     self.redirect(('/post/%s' % str(p.key().id()) + ('/editpost')))
                     return
         else:
@@ -551,25 +1628,20 @@ class EditPost(BlogHandler):
 
 
 class EditComment(BlogHandler):
+    rate_limits = {'POST': None}
 
     def get(self, post_id, comment_id):
-        post = Post.get_by_id(int(comment_id), parent=blog_key())
-        comments = Comment.get_by_id(int(comment_id),
-                                     parent=self.user.key())
-        if comments is not None:
-            content = comments.comment
-            if not self.user:
-                self.render('error.html')
-            else:
-                author = self.user.name
-                commentToEdit = comments.comment
-                commentToEdit = self.request.get('commentToEdit')
-                content = Post.content
-                subject = Post.subject
-                self.render('editcomment.html', subject=subject, post=post,
-                            content=content, comments=comments)
-        else:
+        if not self.user:
+            self.render('error.html')
+            return
+        # Post and comment come back from one batch get
+        post, (comments,) = Post.by_id_with(
+            post_id, comment_key(self.user, comment_id))
+        if post is None or comments is None:
             self.render('error.html')
+            return
+        self.render('editcomment.html', subject=post.subject, post=post,
+                    content=post.content, comments=comments)
 
     def post(self, post_id, comment_id):
         if not self.user:
@@ -583,7 +1655,14 @@ class EditComment(BlogHandler):
                     commentToEdit = comments.comment
                     comment = self.request.get('comment')
                     comments.comment = comment
-                    comments.put()
+
+                    def txn():
+                        comments.put()
+                        jobs.enqueue(comment_saved, str(comments.key()),
+                                     edited=True, _transactional=True)
+
+                    db.run_in_transaction(txn)
+                    self.record_write(comments.key())
                     self.redirect(('/post/%s' % str(post_id) + ('/comment')))
                     return
                 else:
@@ -597,23 +1676,438 @@ class EditComment(BlogHandler):
 class ViewComment(BlogHandler):
 
     def get(self, post_id, comment_id):
-        post = Post.get_by_id(int(post_id), parent=blog_key())
-        comments = Comment.get_by_id(int(comment_id), parent=self.user.key())
-        if post is not None:
-            if comments is not None:
-                self.render('viewcomment.html', post=post,
-                    comments=comments, comment_id=comment_id)
-            else:
-                self.render('error.html')
+        if not self.user:
+            self.redirect('/login')
+            return
+        post, (comments,) = Post.by_id_with(
+            post_id, comment_key(self.user, comment_id))
+        if post is not None and comments is not None:
+            self.render('viewcomment.html', post=post,
+                        comments=comments, comment_id=comment_id)
         else:
             self.render('error.html')
 
-# Fix for data not persisting in development environment datastore ############
+# Handlers for Atom feeds ####################################################
+
+# Newest posts in a feed, and how long a built feed is kept
+FEED_SIZE = 20
+FEED_TTL = 3600
 
-developmentServer = False
+# Put in place of a feed for a while after a write. A feed rebuilt then may
+# come from a query that does not see the write yet, so it is only kept for
+# RECENT_WRITES_TTL seconds.
+FEED_STALE = 'stale'
+
+ATOM_TIME = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def feed_key(author=None):
+    if author:
+        return 'feed:%s:author:%s' % (RENDER_KEY_VERSION, author)
+    return 'feed:%s:all' % RENDER_KEY_VERSION
+
+
+def invalidate_feeds(author):
+    memcache.set_multi({feed_key(): FEED_STALE, feed_key(author): FEED_STALE},
+                       time=RECENT_WRITES_TTL)
+
+
+class Feed(BlogHandler):
+
+    def get(self, author=None):
+        key = feed_key(author)
+        feed = memcache.get(key)
+        if not isinstance(feed, dict):
+            ttl = RECENT_WRITES_TTL if feed == FEED_STALE else FEED_TTL
+            feed = self.build(author)
+            memcache.set(key, feed, time=ttl)
+        if self.not_modified([feed['etag']]):
+            return
+        self.response.headers['Content-Type'] = ('application/atom+xml; '
+                                                 'charset=utf-8')
+        self.write(feed['body'])
+
+    def build(self, author):
+        query = Post.all().order('-created')
+        if author:
+            query.filter('author =', author)
+        posts = query.fetch(FEED_SIZE)
+        last_modified = max([p.last_modified for p in posts] or [None])
+        if last_modified:
+            updated = last_modified.strftime(ATOM_TIME)
+        else:
+            updated = time.strftime(ATOM_TIME, time.gmtime())
+        body = render_str('atom.xml', posts=posts, author=author,
+                          host=self.request.host_url,
+                          path=self.request.path, updated=updated,
+                          time_format=ATOM_TIME)
+        return {'body': body,
+                'etag': hashlib.md5(body.encode('utf-8')).hexdigest()}
+
+# Handler for searching posts and comments ###################################
+
+
+class Search(BlogHandler):
+
+    def get(self):
+        q = self.request.get('q')
+        try:
+            page = max(int(self.request.get('page') or 0), 0)
+        except ValueError:
+            page = 0
+        post_ids = search.search(q) if q else []
+        start = page * PAGE_SIZE
+        posts = Post.get_multi(post_ids[start:start + PAGE_SIZE])
+        params = dict(q=q, total=len(post_ids),
+                      posts=Post.render_multi(posts))
+        if page:
+            params['prev_url'] = '/search?' + urllib.urlencode(
+                {'q': q.encode('utf-8'), 'page': page - 1})
+        if len(post_ids) > start + PAGE_SIZE:
+            params['next_url'] = '/search?' + urllib.urlencode(
+                {'q': q.encode('utf-8'), 'page': page + 1})
+        self.render('search.html', **params)
+
+# Moving legacy posts out of the shared blog_key() entity group #############
+
+# Posts moved per request of the migration
+MIGRATION_BATCH = 100
+
+
+def migrate_legacy_posts(cursor=None, batch_size=MIGRATION_BATCH):
+    # Moves one batch of posts from under blog_key() to root entities with
+    # the same ids, so URLs, comments and likes keep pointing at them.
+    # Returns the cursor for the next batch, or None once none are left.
+    # Safe to re-run: a root copy written by an earlier run is recognized
+    # and its legacy original is deleted.
+    query = Post.all().ancestor(blog_key())
+    if cursor:
+        query.with_cursor(cursor)
+    legacy = query.fetch(batch_size)
+    if not legacy:
+        return None
+    # Root posts get automatic ids, which know nothing of the legacy ones.
+    # Reserving each id before it is checked means no new post can take it
+    # from here on.
+    for p in legacy:
+        db.allocate_id_range(db.Key.from_path('Post', 1), p.key().id(),
+                             p.key().id())
+    # Raw entities, since the copies below only keep Post's properties and
+    # likes may still be stored on the legacy posts
+    entities = datastore.Get([p.key() for p in legacy])
+    roots = datastore.Get([db.Key.from_path('Post', p.key().id())
+                           for p in legacy])
+    migrate_likes(entities)
+    copies = []
+    for p, entity, root in zip(legacy, entities, roots):
+        if root is None:
+            copies.append(Post(key=db.Key.from_path('Post', p.key().id()),
+                               **dict((name, getattr(p, name))
+                                      for name in Post.properties())))
+        elif id_taken(entity, root):
+            renumber_legacy_post(p, entity, root)
+    db.put(copies)
+    db.delete([p.key() for p in legacy])
+    return query.cursor()
+
+
+def id_taken(entity, root):
+    # True when `root`, the root post with a legacy post's id, is another
+    # post that was given the id before it was reserved, rather than the
+    # legacy post's own copy
+    return root is not None and ((root['created'], root['author']) !=
+                                 (entity['created'], entity['author']))
+
+
+def renumber_legacy_post(post, entity, root):
+    # Comments, likes, images and search postings refer to a post by its
+    # bare id, and since `root` was created everything under the shared id
+    # was written for `root`. The legacy post moves to a new id and takes
+    # only what is known to be its own: the likes still stored on it and
+    # the comments written before `root` existed. Its image cannot be told
+    # apart from root's and is dropped.
+    new_id = entity.get(LEGACY_NEW_ID)
+    if new_id is None:
+        allocated = db.allocate_ids(db.Key.from_path('Post', 1), 1)[0]
+
+        def mark():
+            current = datastore.Get([entity.key()])[0]
+            if LEGACY_NEW_ID not in current:
+                current[LEGACY_NEW_ID] = allocated
+                datastore.Put(current)
+            return current
+
+        entity = db.run_in_transaction(mark)
+        new_id = entity[LEGACY_NEW_ID]
+    logging.warning('Post id %d is taken by another root post; moving the '
+                    'legacy post to id %d', post.key().id(), new_id)
+    migrate_post_likes(entity, {}, new_id)
+    props = dict((name, getattr(post, name)) for name in Post.properties())
+    props.update(image_version=0, image_widths=[])
+    copy = Post(key=db.Key.from_path('Post', new_id), **props)
+    db.put(copy)
+    comments = [c for c in Comment.all().filter('post =',
+                                                str(post.key().id()))
+                if c.created < root['created']]
+    for c in comments:
+        c.post = str(new_id)
+    db.put(comments)
+    jobs.enqueue(post_saved, new_id)
+    jobs.enqueue(recount_comments, copy.key())
+    jobs.enqueue(recount_comments, root.key())
+    for c in comments:
+        jobs.enqueue(comment_saved, c.key(), True)
+
+
+class MigratePosts(BlogHandler):
+
+    def get(self):
+        if not users.is_current_user_admin():
+            self.error(403)
+            return
+        cursor = migrate_legacy_posts(self.request.get('cursor'))
+        if cursor:
+            self.redirect('/_admin/migrate-posts?cursor=%s' % cursor)
+        else:
+            self.write('All posts migrated.')
+
+# Moving likes stored on legacy posts into Like entities ###################
+
+# Legacy posts kept likers as a space separated string of names, starting
+# with "none". While its Like entities are written, a post holds the ids of
+# the users they are for under LEGACY_LIKE_USERS.
+LEGACY_LIKERS = 'likers'
+LEGACY_LIKE_USERS = 'legacy_like_user_ids'
+# The id a legacy post whose id was taken is moving to
+LEGACY_NEW_ID = 'legacy_new_id'
+
+
+def legacy_like_user_ids(entity, user_ids):
+    # `user_ids` maps names to ids (None for unknown names) across a batch
+    uids = []
+    for name in set((entity.get(LEGACY_LIKERS) or '').split()) - {'none'}:
+        if name not in user_ids:
+            user = User.by_name(name)
+            user_ids[name] = user and user.key().id()
+        if user_ids[name] is not None:
+            uids.append(user_ids[name])
+    return uids
+
+
+def migrate_post_likes(entity, user_ids, post_id=None):
+    # Writes the likes for post `post_id`, by default the entity's own id.
+    # Likes or counts already written are never written again, so this is
+    # safe to re-run after a failure at any step:
+    # 1. One shard gets the likes that have no Like entity yet, in the same
+    #    transaction that swaps `likers` for the ids still to be written.
+    # 2. The Like entities are put.
+    # 3. The ids are removed from the post.
+    post_id = post_id or entity.key().id()
+    if LEGACY_LIKERS in entity:
+        uids = legacy_like_user_ids(entity, user_ids)
+        like_keys = [Like.key_for(post_id, uid) for uid in uids]
+        missing = [uid for uid, like in zip(uids, db.get(like_keys))
+                   if like is None]
+        shard_key = LikeShard.keys_for(post_id)[0]
+
+        def swap():
+            current = datastore.Get([entity.key()])[0]
+            if current is None or LEGACY_LIKERS not in current:
+                return current
+            shard = db.get(shard_key) or LikeShard(key=shard_key)
+            shard.count += len(missing)
+            del current[LEGACY_LIKERS]
+            if 'likes' in current:
+                del current['likes']
+            if missing:
+                current[LEGACY_LIKE_USERS] = missing
+            datastore.Put(current)
+            shard.put()
+            return current
+
+        options = db.create_transaction_options(xg=True)
+        entity = db.run_in_transaction_options(options, swap)
+        memcache.delete(like_count_key(post_id), seconds=LIKE_COUNT_LOCK)
+    pending = entity and entity.get(LEGACY_LIKE_USERS)
+    if not pending:
+        return
+    db.put([Like(key=Like.key_for(post_id, uid), post_id=post_id,
+                 user_id=uid) for uid in pending])
+
+    def clear():
+        current = datastore.Get([entity.key()])[0]
+        if current is not None and LEGACY_LIKE_USERS in current:
+            del current[LEGACY_LIKE_USERS]
+            datastore.Put(current)
+
+    db.run_in_transaction(clear)
+
+
+def migrate_likes(entities):
+    user_ids = {}
+    legacy = [e for e in entities if e is not None and e.key().parent()]
+    roots = legacy and datastore.Get([db.Key.from_path('Post', e.key().id())
+                                      for e in legacy])
+    # Their likes go with them to a new id in renumber_legacy_post
+    taken = set(e.key() for e, root in zip(legacy, roots)
+                if id_taken(e, root))
+    for entity in entities:
+        if entity is None or entity.key() in taken:
+            continue
+        if LEGACY_LIKERS in entity or LEGACY_LIKE_USERS in entity:
+            migrate_post_likes(entity, user_ids)
+
+
+def migrate_likes_batch(cursor=None, batch_size=MIGRATION_BATCH):
+    # Reads raw entities, since Post drops properties it does not declare.
+    # Returns the cursor for the next batch, or None when done.
+    query = datastore.Query('Post', cursor=cursor and
+                            datastore_query.Cursor(urlsafe=cursor))
+    batch = query.Get(batch_size)
+    migrate_likes(batch)
+    return batch and query.GetCursor().urlsafe() or None
+
+
+class MigrateLikes(BlogHandler):
+
+    def get(self):
+        if not users.is_current_user_admin():
+            self.error(403)
+            return
+        cursor = migrate_likes_batch(self.request.get('cursor'))
+        if cursor:
+            self.redirect('/_admin/migrate-likes?cursor=%s' % cursor)
+        else:
+            self.write('All likes migrated.')
+
+# Reserving the names of accounts created before Username existed ###########
+
+
+def reserve_usernames(cursor=None, batch_size=MIGRATION_BATCH):
+    # Gives one batch of accounts their Username row, so User.by_name can
+    # find them. Returns the cursor for the next batch, or None when done.
+    accounts, cursor = fetch_page(User.all().ancestor(users_key()), cursor,
+                                  batch_size)
+    reserved = Username.get_by_key_name([u.name for u in accounts])
+    for u, r in zip(accounts, reserved):
+        if r is None:
+            r = Username.get_or_insert(u.name, uid=u.key().id())
+        if r.uid != u.key().id():
+            logging.warning('Name %s is held by user %d; user %d cannot '
+                            'sign in', u.name, r.uid, u.key().id())
+    return cursor
+
+
+class ReserveUsernames(BlogHandler):
+
+    def get(self):
+        if not users.is_current_user_admin():
+            self.error(403)
+            return
+        cursor = reserve_usernames(self.request.get('cursor'))
+        if cursor:
+            self.redirect('/_admin/reserve-usernames?cursor=%s' % cursor)
+        else:
+            self.write('All usernames reserved.')
+
+# Rebuilding the search index for existing posts and comments ##############
+
+
+def reindex_batch(kind, cursor=None, batch_size=MIGRATION_BATCH):
+    # Indexes one batch of `kind` ('Post' or 'Comment'). Returns the cursor
+    # for the next batch, or None once every entity has been indexed.
+    query = (Post if kind == 'Post' else Comment).all()
+    if cursor:
+        query.with_cursor(cursor)
+    batch = query.fetch(batch_size)
+    for entity in batch:
+        if kind == 'Post':
+            index_post(entity)
+        else:
+            index_comment(entity)
+    return batch and query.cursor() or None
+
+
+class ReindexSearch(BlogHandler):
+
+    def get(self):
+        if not users.is_current_user_admin():
+            self.error(403)
+            return
+        kind = self.request.get('kind') or 'Post'
+        cursor = reindex_batch(kind, self.request.get('cursor'))
+        if cursor:
+            self.redirect('/_admin/reindex?%s' % urllib.urlencode(
+                {'kind': kind, 'cursor': cursor}))
+        elif kind == 'Post':
+            self.redirect('/_admin/reindex?kind=Comment')
+        else:
+            self.write('Search index rebuilt.')
+
+# Re-rendering post bodies after a markup.RENDER_VERSION bump ###############
+
+
+def rerender_post(post_key):
+    # Re-reads the post in the transaction, so a concurrent edit, comment
+    # count or thumbnail write is never overwritten with stale values
+    def txn():
+        post = db.get(post_key)
+        if post is not None and post.render_version != markup.RENDER_VERSION:
+            post.render_body()
+            post.put()
+
+    db.run_in_transaction(txn)
+
+
+def rerender_batch(cursor=None, batch_size=MIGRATION_BATCH):
+    # Stores freshly rendered HTML for the stale posts in one batch, then
+    # queues the next batch. Posts without a render_version are missing
+    # from its index, so this scans every post rather than filtering on
+    # the version.
+    posts, cursor = fetch_page(Post.all(), cursor, batch_size)
+    for p in posts:
+        if p.render_version != markup.RENDER_VERSION:
+            rerender_post(p.key())
+    if cursor:
+        jobs.enqueue(rerender_batch, cursor)
+
+
+class RerenderPosts(BlogHandler):
+
+    def get(self):
+        if not users.is_current_user_admin():
+            self.error(403)
+            return
+        jobs.enqueue(rerender_batch)
+        self.write('Re-render to version %d started.' %
+                   markup.RENDER_VERSION)
+
+# Rebuilding derived counts and caches ######################################
+
+
+class RecountPosts(BlogHandler):
+
+    def get(self):
+        if not users.is_current_user_admin():
+            self.error(403)
+            return
+        jobs.enqueue(recount_batch)
+        self.write('Recount started.')
+
+# Admin-only request statistics (also restricted in app.yaml) ###############
+
+
+class Stats(BlogHandler):
+
+    def get(self):
+        if not users.is_current_user_admin():
+            self.error(403)
+            return
+        self.response.headers['Content-Type'] = 'application/json'
+        self.write(json.dumps(stats.snapshot(), indent=2, sort_keys=True))
+
+# Fix for data not persisting in development environment datastore ############
 
-if os.environ.get('SERVER_SOFTWARE','').startswith('Development'):
-    developmentServer = True
 
 class BaseRequestHandler(webapp2.RequestHandler):
     def dispatch(self):
@@ -627,6 +2121,8 @@ class BaseRequestHandler(webapp2.RequestHandler):
 
 # WSGI Mapping ################################################################
 
+stats.install_hooks()
+
 app = webapp2.WSGIApplication([('/', MainPage),
                                ('/blog/?', BlogFront),
                                ('/post/([0-9]+)', PostPage),
@@ -646,4 +2142,22 @@ app = webapp2.WSGIApplication([('/', MainPage),
                                ('/logout', Logout),
                                ('/welcome', Welcome),
                                ('/welcome/myposts', MyPosts),
+                               ('/home', Home),
+                               ('/image/([0-9]+)/([0-9]+)/([0-9]+)',
+                                ImageFile),
+                               ('/author/([a-zA-Z0-9_-]+)/follow',
+                                FollowAuthor),
+                               ('/search', Search),
+                               ('/feed.atom', Feed),
+                               ('/author/([a-zA-Z0-9_-]+)/feed.atom', Feed),
+                               ('/comments/recent', RecentComments),
+                               ('/_stats', Stats),
+                               ('/_admin/migrate-posts', MigratePosts),
+                               ('/_admin/migrate-likes', MigrateLikes),
+                               ('/_admin/reserve-usernames',
+                                ReserveUsernames),
+                               ('/_admin/reindex', ReindexSearch),
+                               ('/_admin/rerender', RerenderPosts),
+                               ('/_admin/recount', RecountPosts),
                                ], debug=True)
+app = stats.StatsMiddleware(app)
@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+
+# In-process caches shared by every request an instance serves ###############
+
+
+class LRUCache(object):
+    # Least-recently-used cache with a per-entry time to live. Instances run
+    # threadsafe, so every operation holds the lock.
+
+    def __init__(self, capacity=1000, ttl=60):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class TieredCache(object):
+    # Local LRU in front of an optional shared tier. The shared tier is
+    # anything with memcache's get/set/delete signatures, so tests can pass
+    # a local stand-in instead of the memcache module.
+
+    def __init__(self, local, shared=None, prefix='', ttl=0):
+        self.local = local
+        self.shared = shared
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(self.prefix + str(key))
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(self.prefix + str(key), value, time=self.ttl)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(self.prefix + str(key))
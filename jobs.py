@@ -0,0 +1,43 @@
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+
+# Background jobs ############################################################
+#
+# Work that can wait until after a write has committed runs here instead of
+# in the request: search indexing, cache invalidation, timeline fan-out,
+# thumbnails and cascade deletes. A job is a module-level function run
+# through deferred on the queue defined in queue.yaml. Tasks are delivered
+# at least once and failed ones are retried with backoff, so every job must
+# leave the same result when it runs twice.
+
+QUEUE = 'jobs'
+
+# Raise from a job to stop retrying it
+PermanentFailure = deferred.PermanentTaskFailure
+
+
+def enqueue(func, *args, **kwargs):
+    # Runs func(*args, **kwargs) in a task. deferred's options apply:
+    # _transactional=True adds the job only if the surrounding datastore
+    # transaction commits, and a job given a _name is added at most once.
+    kwargs.setdefault('_queue', QUEUE)
+    try:
+        deferred.defer(func, *args, **kwargs)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.info('job %s was already added', kwargs.get('_name'))
+
+
+def run_pending(stub, queue=QUEUE):
+    # Runs queued jobs in this process until none are left, including jobs
+    # they add. For tools and tests using the testbed taskqueue stub.
+    ran = 0
+    while True:
+        tasks = stub.get_filtered_tasks(queue_names=[queue])
+        if not tasks:
+            return ran
+        stub.FlushQueue(queue)
+        for task in tasks:
+            deferred.run(task.payload)
+            ran += 1
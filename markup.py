@@ -0,0 +1,101 @@
+import cgi
+import re
+
+# Post body rendering ########################################################
+#
+# A small, safe subset of Markdown: paragraphs, line breaks, # headings,
+# - and 1. lists, > quotes, indented code blocks, **bold**, *emphasis*,
+# `code` and [links](http://...). Input is HTML-escaped before any markup
+# is applied, so the only tags in the output are the ones made here.
+
+# Bump whenever the output changes. Posts stored with an older version are
+# rendered on the fly until /_admin/rerender has updated them.
+RENDER_VERSION = 3
+
+BLANK_LINE_RE = re.compile(r'\n[ \t]*\n')
+HEADING_RE = re.compile(r'^(#{1,3})\s+(\S.*)$')
+BULLET_RE = re.compile(r'^\s*[-*+]\s+(.*)$')
+NUMBERED_RE = re.compile(r'^\s*\d+\.\s+(.*)$')
+QUOTE_RE = re.compile(r'^\s*&gt;\s?(.*)$')
+CODE_SPAN_RE = re.compile(r'`([^`\n]+)`')
+STRONG_RE = re.compile(r'\*\*(?=\S)(.+?)(?<=\S)\*\*')
+EM_RE = re.compile(r'\*(?=\S)(.+?)(?<=\S)\*')
+LINK_RE = re.compile(r'\[([^\]\n]+)\]\(([^)\s]+)\)')
+SAFE_URL_RE = re.compile(r'^(https?://|mailto:|/)', re.IGNORECASE)
+PLACEHOLDER_RE = re.compile('\x00(\\d+)\x00')
+
+
+def _link(match, keep):
+    text, url = match.groups()
+    if not SAFE_URL_RE.match(url) or '\x00' in url:
+        # A NUL here is a code span placeholder, which must not end up
+        # inside the href
+        return None
+    return '<a href="%s" rel="nofollow">%s</a>' % (url, emphasis(text, keep))
+
+
+def emphasis(text, keep):
+    # Each <strong> is marked up inside and then set aside, so an *em*
+    # can only close within the span it opened in and tags always nest
+    text = STRONG_RE.sub(
+        lambda m: keep('<strong>%s</strong>' % EM_RE.sub(r'<em>\1</em>',
+                                                         m.group(1))),
+        text)
+    return EM_RE.sub(r'<em>\1</em>', text)
+
+
+def inline(text):
+    # `text` is already escaped and free of NULs. Code spans and links are
+    # set aside behind NUL placeholders first, so nothing inside them is
+    # treated as markup.
+    spans = []
+
+    def keep(html):
+        spans.append(html)
+        return '\x00%d\x00' % (len(spans) - 1)
+
+    text = CODE_SPAN_RE.sub(lambda m: keep('<code>%s</code>' % m.group(1)),
+                            text)
+    text = LINK_RE.sub(lambda m: keep(_link(m, keep) or m.group(0)), text)
+    text = emphasis(text, keep)
+
+    def restore(match):
+        # Link text and <strong> can hold other placeholders
+        return PLACEHOLDER_RE.sub(restore, spans[int(match.group(1))])
+
+    return PLACEHOLDER_RE.sub(restore, text)
+
+
+def _list(tag, pattern, lines):
+    items = ''.join('<li>%s</li>' % inline(pattern.match(l).group(1))
+                    for l in lines)
+    return '<%s>%s</%s>' % (tag, items, tag)
+
+
+def block(text):
+    lines = text.split('\n')
+    heading = HEADING_RE.match(text)
+    if heading and len(lines) == 1:
+        level = len(heading.group(1)) + 2
+        return '<h%d>%s</h%d>' % (level, inline(heading.group(2)), level)
+    if all(BULLET_RE.match(l) for l in lines):
+        return _list('ul', BULLET_RE, lines)
+    if all(NUMBERED_RE.match(l) for l in lines):
+        return _list('ol', NUMBERED_RE, lines)
+    if all(QUOTE_RE.match(l) for l in lines):
+        quoted = [QUOTE_RE.match(l).group(1) for l in lines]
+        return '<blockquote>%s</blockquote>' % '<br>'.join(
+            inline(l) for l in quoted)
+    if all(l.startswith('    ') or l.startswith('\t') for l in lines):
+        code = '\n'.join(l[4:] if l.startswith('    ') else l[1:]
+                         for l in lines)
+        return '<pre><code>%s</code></pre>' % code
+    return '<p>%s</p>' % '<br>'.join(inline(l) for l in lines)
+
+
+def render(text):
+    # NUL is reserved for inline()'s placeholders
+    text = (text or '').replace('\r\n', '\n').replace('\x00', '')
+    text = cgi.escape(text, quote=True)
+    blocks = [b for b in BLANK_LINE_RE.split(text.strip('\n')) if b.strip()]
+    return '\n'.join(block(b) for b in blocks)
@@ -0,0 +1,115 @@
+import binascii
+import hashlib
+import hmac
+import os
+
+# Password hashing ###########################################################
+#
+# Stored hashes are "<algorithm>$<params...>". Hashes written before this
+# module existed are "<salt>,<sha256 hex>" and are still accepted, so old
+# accounts can log in and be upgraded to the current hasher.
+
+# PBKDF2 rounds for new hashes. Size it with tools/bench_passwords.py against
+# the Login.post latency budget; raising it upgrades users as they log in.
+DEFAULT_ITERATIONS = 10000
+
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _equal(a, b):
+    # Constant time, so comparing hashes does not leak how much matched
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(a, b)
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def pbkdf2_sha256(password, salt, iterations):
+    if hasattr(hashlib, 'pbkdf2_hmac'):
+        return hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+    # Pure Python fallback for runtimes older than 2.7.8. One block is
+    # enough because the key is exactly one SHA-256 digest long.
+    mac = hmac.new(password, digestmod=hashlib.sha256)
+
+    def prf(data):
+        m = mac.copy()
+        m.update(data)
+        return m.digest()
+
+    u = prf(salt + '\x00\x00\x00\x01')
+    result = int(binascii.hexlify(u), 16)
+    for _ in xrange(iterations - 1):
+        u = prf(u)
+        result ^= int(binascii.hexlify(u), 16)
+    return binascii.unhexlify('%064x' % result)
+
+
+class PBKDF2Hasher(object):
+    algorithm = 'pbkdf2_sha256'
+
+    def __init__(self, iterations=DEFAULT_ITERATIONS):
+        self.iterations = iterations
+
+    def encode(self, password, salt=None):
+        if salt is None:
+            salt = binascii.hexlify(os.urandom(16))
+        digest = pbkdf2_sha256(_to_bytes(password), salt, self.iterations)
+        return '%s$%d$%s$%s' % (self.algorithm, self.iterations, salt,
+                                binascii.hexlify(digest))
+
+    def verify(self, name, password, encoded):
+        algorithm, iterations, salt, digest = encoded.split('$')
+        expected = pbkdf2_sha256(_to_bytes(password), salt, int(iterations))
+        return _equal(binascii.hexlify(expected), digest)
+
+    def needs_rehash(self, encoded):
+        return encoded.split('$')[1] != str(self.iterations)
+
+
+class LegacySHA256Hasher(object):
+    # Single salted SHA-256 round over name + password + salt. Only used to
+    # verify hashes written before PBKDF2; every match is rehashed.
+    algorithm = 'sha256'
+
+    def verify(self, name, password, encoded):
+        salt = encoded.split(',')[0]
+        digest = hashlib.sha256(_to_bytes(name + password + salt))
+        return _equal('%s,%s' % (salt, digest.hexdigest()), encoded)
+
+    def needs_rehash(self, encoded):
+        return True
+
+
+# The hasher new passwords are stored with
+hasher = PBKDF2Hasher()
+
+HASHERS = {PBKDF2Hasher.algorithm: hasher,
+           LegacySHA256Hasher.algorithm: LegacySHA256Hasher()}
+
+
+def hasher_for(encoded):
+    if '$' not in encoded:
+        return HASHERS[LegacySHA256Hasher.algorithm]
+    return HASHERS.get(encoded.split('$')[0])
+
+
+def make_hash(password):
+    return hasher.encode(password)
+
+
+def verify(name, password, encoded):
+    h = encoded and hasher_for(encoded)
+    return bool(h and h.verify(name, password, encoded))
+
+
+def needs_rehash(encoded):
+    h = hasher_for(encoded)
+    return h is not hasher or h.needs_rehash(encoded)
@@ -0,0 +1,65 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+# Token bucket rate limiting ##################################################
+#
+# Each client gets a bucket holding up to `burst` tokens that refills at
+# `rate` tokens per second, and every request spends one. Buckets live in
+# the instance, so a check is a dict lookup and some arithmetic under a
+# lock. An optional shared tier (memcache) also counts requests across
+# instances in fixed windows of burst / rate seconds; it is only consulted
+# once the local bucket has allowed the request, so throttled clients cost
+# no RPC at all.
+
+
+class RateLimiter(object):
+
+    def __init__(self, rate, burst, shared=None, prefix='ratelimit:',
+                 capacity=10000):
+        self.rate = float(rate)
+        self.burst = burst
+        self.shared = shared
+        self.prefix = prefix
+        self.capacity = capacity
+        self.window = max(1, int(math.ceil(burst / self.rate)))
+        # client -> (tokens, last refill time), least recently seen first
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, client):
+        # Spends a token for `client`. Returns 0 when the request may go
+        # ahead, otherwise the number of seconds to wait before retrying.
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets[client] = (tokens, now)
+                return int(math.ceil((1 - tokens) / self.rate))
+            self._buckets[client] = (tokens - 1, now)
+            while len(self._buckets) > self.capacity:
+                self._buckets.popitem(last=False)
+        if self.shared is not None:
+            return self._check_shared(client, now)
+        return 0
+
+    def _check_shared(self, client, now):
+        window = int(now) // self.window
+        key = '%s%s:%d' % (self.prefix, client, window)
+        # incr(initial_value=) would create the key with no expiry, leaving
+        # every window's counter in memcache until evicted
+        self.shared.add(key, 0, time=self.window)
+        count = self.shared.incr(key)
+        if count is None or count <= self.burst:
+            # A memcache outage must not lock everyone out
+            return 0
+        return (window + 1) * self.window - int(now)
+
+    def reset(self, client=None):
+        with self._lock:
+            if client is None:
+                self._buckets.clear()
+            else:
+                self._buckets.pop(client, None)
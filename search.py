@@ -0,0 +1,120 @@
+import math
+import re
+from collections import defaultdict
+
+from google.appengine.ext import db
+
+# Full-text search ###########################################################
+#
+# Inverted index kept in the datastore: one Posting per (term, document).
+# Documents are posts and comments, and both resolve to the post they
+# belong to, so a query returns ranked post ids.
+
+# Distinct terms indexed per document. Bounds the entities one write puts.
+MAX_TERMS_PER_DOC = 100
+
+# Query terms used and postings read per term, bounding the cost of a search
+MAX_QUERY_TERMS = 5
+MAX_POSTINGS_PER_TERM = 200
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Longer words are not indexed, which also keeps posting key names short
+MAX_TERM_LENGTH = 40
+
+STOP_WORDS = frozenset('a an and are as at be but by for from has have i in '
+                       'is it its of on or that the this to was were will '
+                       'with you'.split())
+
+
+class SearchDocument(db.Model):
+    # Key name is the document id, e.g. "Post:12" or "Comment:7:34"
+    post_id = db.IntegerProperty(required=True)
+    terms = db.StringListProperty(indexed=False)
+
+
+class Posting(db.Model):
+    # Key name is "<document id> <term>"
+    term = db.StringProperty(required=True)
+    post_id = db.IntegerProperty(required=True, indexed=False)
+    weight = db.FloatProperty(required=True)
+
+
+def tokenize(text):
+    return [w for w in WORD_RE.findall(text.lower())
+            if 1 < len(w) <= MAX_TERM_LENGTH and w not in STOP_WORDS]
+
+
+def term_weights(fields):
+    # Term frequency over (text, boost) fields, normalized by length and
+    # cut to the MAX_TERMS_PER_DOC heaviest terms.
+    counts = defaultdict(float)
+    length = 0
+    for text, boost in fields:
+        words = tokenize(text or '')
+        length += len(words)
+        for w in words:
+            counts[w] += boost
+    if not counts:
+        return {}
+    norm = math.sqrt(length)
+    top = sorted(counts.iteritems(), key=lambda item: -item[1])
+    return dict((term, count / norm)
+                for term, count in top[:MAX_TERMS_PER_DOC])
+
+
+def posting_key(term, doc_id):
+    return db.Key.from_path('Posting', '%s %s' % (doc_id, term))
+
+
+def index_document(doc_id, post_id, fields):
+    # Replaces the postings of one document, deleting terms it no longer
+    # contains. Costs one get plus one batch put and delete.
+    weights = term_weights(fields)
+    doc = SearchDocument.get_by_key_name(doc_id)
+    if doc:
+        stale = set(doc.terms) - set(weights)
+        db.delete([posting_key(t, doc_id) for t in stale])
+    entities = [Posting(key=posting_key(t, doc_id), term=t, post_id=post_id,
+                        weight=w) for t, w in weights.iteritems()]
+    entities.append(SearchDocument(key_name=doc_id, post_id=post_id,
+                                   terms=weights.keys()))
+    db.put(entities)
+
+
+def unindex_document(doc_id):
+    doc = SearchDocument.get_by_key_name(doc_id)
+    if doc:
+        db.delete([posting_key(t, doc_id) for t in doc.terms] + [doc])
+
+
+def unindex_post(post_id):
+    # Removes a post and every comment indexed under it
+    keys = []
+    for doc in SearchDocument.all().filter('post_id =', post_id).run():
+        keys.extend(posting_key(t, doc.key().name()) for t in doc.terms)
+        keys.append(doc.key())
+    db.delete(keys)
+
+
+def search(query):
+    # Returns post ids for `query`, best match first. Each term scores its
+    # postings by weight * idf, where rarer terms have fewer postings.
+    terms = []
+    for t in tokenize(query):
+        if t not in terms:
+            terms.append(t)
+    terms = terms[:MAX_QUERY_TERMS]
+    # run() issues every term's query before any result is read
+    runs = [Posting.all().filter('term =', t).order('-weight').run(
+        limit=MAX_POSTINGS_PER_TERM, batch_size=MAX_POSTINGS_PER_TERM)
+        for t in terms]
+    scores = defaultdict(float)
+    for postings in runs:
+        postings = list(postings)
+        if not postings:
+            continue
+        idf = math.log(1.0 + float(MAX_POSTINGS_PER_TERM) / len(postings))
+        for p in postings:
+            scores[p.post_id] += p.weight * idf
+    return sorted(scores, key=lambda pid: -scores[pid])
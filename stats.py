@@ -0,0 +1,175 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from google.appengine.api import apiproxy_stub_map
+
+# Request instrumentation ####################################################
+#
+# StatsMiddleware wraps the WSGI app and times every request. API proxy
+# hooks count and time the datastore and memcache RPCs a request makes, and
+# blog.py reports its template render time. Each request is logged as one
+# JSON line and folded into per-route histograms served by /_stats.
+# render_ms counts only the outermost template render of a request, less
+# the datastore and memcache RPCs made lazily while it ran.
+
+# Samples kept per route for percentiles. Histograms are per instance.
+SAMPLES_PER_ROUTE = 1000
+
+PERCENTILES = (50, 90, 95, 99)
+
+# RPC services broken out separately in the stats
+SERVICES = ('datastore_v3', 'memcache')
+
+_local = threading.local()
+_routes = {}
+_routes_lock = threading.Lock()
+
+
+class RequestStats(object):
+
+    def __init__(self, path):
+        # Handlers name the route, so /post/1 and /post/2 share histograms
+        self.route = 'unrouted'
+        self.path = path
+        self.start = time.time()
+        self.status = None
+        self.response_size = 0
+        self.render_time = 0.0
+        self.render_depth = 0
+        self.rpcs = dict((s, [0, 0.0]) for s in SERVICES)
+        self._pending = {}
+
+    def as_dict(self):
+        record = {'route': self.route,
+                  'path': self.path,
+                  'status': self.status,
+                  'wall_ms': round((time.time() - self.start) * 1000, 2),
+                  'render_ms': round(self.render_time * 1000, 2),
+                  'response_bytes': self.response_size}
+        for service, (count, seconds) in self.rpcs.iteritems():
+            record['%s_rpcs' % service] = count
+            record['%s_ms' % service] = round(seconds * 1000, 2)
+        return record
+
+    def rpc_time(self):
+        return sum(seconds for _, seconds in self.rpcs.itervalues())
+
+
+def current():
+    return getattr(_local, 'stats', None)
+
+
+def set_route(route):
+    s = current()
+    if s:
+        s.route = route
+
+
+@contextmanager
+def rendering():
+    # Times the template render inside the block. Renders nested in it,
+    # such as post fragments rendered while a listing streams, are already
+    # covered by the outer block and are not counted again.
+    s = current()
+    if s is None:
+        yield
+        return
+    s.render_depth += 1
+    if s.render_depth == 1:
+        start, rpc_start = time.time(), s.rpc_time()
+    try:
+        yield
+    finally:
+        s.render_depth -= 1
+        if not s.render_depth:
+            elapsed = time.time() - start - (s.rpc_time() - rpc_start)
+            s.render_time += max(0.0, elapsed)
+
+
+def _pre_call(service, call, request, response, rpc=None):
+    s = current()
+    if s and service in s.rpcs:
+        s._pending[id(response)] = time.time()
+
+
+def _post_call(service, call, request, response, rpc=None, error=None):
+    s = current()
+    started = s and s._pending.pop(id(response), None)
+    if started:
+        totals = s.rpcs[service]
+        totals[0] += 1
+        totals[1] += time.time() - started
+
+
+def install_hooks():
+    hooks = apiproxy_stub_map.apiproxy
+    hooks.GetPreCallHooks().Append('stats_pre', _pre_call)
+    hooks.GetPostCallHooks().Append('stats_post', _post_call)
+
+
+def _record(record):
+    with _routes_lock:
+        held = _routes.get(record['route'])
+        if held is None:
+            held = _routes[record['route']] = deque(maxlen=SAMPLES_PER_ROUTE)
+        held.append(record)
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return dict(('p%d' % p,
+                 values[min(len(values) - 1, len(values) * p // 100)])
+                for p in PERCENTILES)
+
+
+def samples():
+    # {route: [request record, ...]} for the requests still held
+    with _routes_lock:
+        return dict((r, list(s)) for r, s in _routes.iteritems())
+
+
+def snapshot():
+    # {route: {'count': n, metric: {'p50': ..., ...}}} over recent requests
+    result = {}
+    for route, records in samples().iteritems():
+        summary = {'count': len(records)}
+        for metric in records[0]:
+            if metric not in ('route', 'path', 'status'):
+                summary[metric] = percentiles([r[metric] for r in records])
+        result[route] = summary
+    return result
+
+
+class StatsMiddleware(object):
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        s = _local.stats = RequestStats(environ.get('PATH_INFO'))
+
+        def _start_response(status, headers, exc_info=None):
+            s.status = int(status.split()[0])
+            return start_response(status, headers, exc_info)
+
+        try:
+            result = self.app(environ, _start_response)
+            try:
+                body = list(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+            s.response_size = sum(len(chunk) for chunk in body)
+            return body
+        finally:
+            _local.stats = None
+            record = s.as_dict()
+            _record(record)
+            logging.info('request_stats %s', json.dumps(record,
+                                                        sort_keys=True))
@@ -0,0 +1,115 @@
+# Tests for the post body renderer. Its output is shown with |safe, so
+# these cover escaping and URL checks as well as the markup itself.
+#
+#   python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import markup
+
+
+class EscapingTest(unittest.TestCase):
+
+    def test_html_is_escaped(self):
+        self.assertEqual(markup.render('<script>alert("x")</script> & co'),
+                         '<p>&lt;script&gt;alert(&quot;x&quot;)'
+                         '&lt;/script&gt; &amp; co</p>')
+
+    def test_markup_inside_escaped_text_stays_escaped(self):
+        self.assertEqual(markup.render('**<b>**'),
+                         '<p><strong>&lt;b&gt;</strong></p>')
+
+    def test_nul_is_dropped(self):
+        self.assertEqual(markup.render('a\x000\x00b'), '<p>a0b</p>')
+
+    def test_nul_cannot_forge_a_placeholder(self):
+        self.assertEqual(markup.render('`x` \x000\x00'),
+                         '<p><code>x</code> 0</p>')
+
+    def test_empty(self):
+        self.assertEqual(markup.render(None), '')
+        self.assertEqual(markup.render('\n\n'), '')
+
+
+class LinkTest(unittest.TestCase):
+
+    def test_safe_link(self):
+        self.assertEqual(markup.render('[site](https://example.com/a)'),
+                         '<p><a href="https://example.com/a" '
+                         'rel="nofollow">site</a></p>')
+
+    def test_unsafe_urls_are_left_as_text(self):
+        for url in ('javascript:alert(1)', 'JavaScript:x', 'data:text/html',
+                    'vbscript:x'):
+            html = markup.render('[x](%s)' % url)
+            self.assertNotIn('<a', html, url)
+
+    def test_quotes_cannot_break_out_of_href(self):
+        html = markup.render('[x](http://a.com/"onmouseover="y)')
+        self.assertIn('href="http://a.com/&quot;onmouseover=&quot;y"', html)
+
+    def test_emphasis_is_not_applied_inside_href(self):
+        self.assertEqual(markup.render('[x](http://a.com/*b*/c)'),
+                         '<p><a href="http://a.com/*b*/c" '
+                         'rel="nofollow">x</a></p>')
+
+    def test_emphasis_cannot_close_inside_href(self):
+        self.assertEqual(markup.render('*[a](http://x*y)'),
+                         '<p>*<a href="http://x*y" rel="nofollow">a</a></p>')
+
+    def test_link_text_keeps_inline_markup(self):
+        self.assertEqual(markup.render('[**b** `c`](/p)'),
+                         '<p><a href="/p" rel="nofollow"><strong>b</strong> '
+                         '<code>c</code></a></p>')
+
+    def test_overlapping_emphasis_stays_nested(self):
+        self.assertEqual(markup.render('**a *b** c*'),
+                         '<p><strong>a *b</strong> c*</p>')
+        self.assertEqual(markup.render('*a **b* c**'),
+                         '<p>*a <strong>b* c</strong></p>')
+
+    def test_nested_emphasis(self):
+        self.assertEqual(markup.render('*a **b** c*'),
+                         '<p><em>a <strong>b</strong> c</em></p>')
+        self.assertEqual(markup.render('**a *b* c**'),
+                         '<p><strong>a <em>b</em> c</strong></p>')
+
+    def test_code_span_cannot_end_up_in_href(self):
+        self.assertEqual(markup.render('[a](http://x`y`)'),
+                         '<p>[a](http://x<code>y</code>)</p>')
+
+
+class BlockTest(unittest.TestCase):
+
+    def test_paragraphs_and_line_breaks(self):
+        self.assertEqual(markup.render('one\ntwo\n\nthree'),
+                         '<p>one<br>two</p>\n<p>three</p>')
+
+    def test_heading(self):
+        self.assertEqual(markup.render('# Title'), '<h3>Title</h3>')
+
+    def test_empty_heading_is_text(self):
+        self.assertEqual(markup.render('# '), '<p># </p>')
+        self.assertEqual(markup.render('##'), '<p>##</p>')
+
+    def test_lists(self):
+        self.assertEqual(markup.render('- a\n- b'),
+                         '<ul><li>a</li><li>b</li></ul>')
+        self.assertEqual(markup.render('1. a\n2. b'),
+                         '<ol><li>a</li><li>b</li></ol>')
+
+    def test_quote(self):
+        self.assertEqual(markup.render('> quoted'),
+                         '<blockquote>quoted</blockquote>')
+
+    def test_code_block_is_not_marked_up(self):
+        self.assertEqual(markup.render('    *x* <y>'),
+                         '<pre><code>*x* &lt;y&gt;</code></pre>')
+
+
+if __name__ == '__main__':
+    unittest.main()
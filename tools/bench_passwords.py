@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# Measures what one login costs at each PBKDF2 work factor, to size
+# passwords.DEFAULT_ITERATIONS against the Login.post latency budget.
+#
+#   python tools/bench_passwords.py [--rounds N] [--json] [ITERATIONS ...]
+
+import json
+import os
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import passwords
+
+DEFAULT_WORK_FACTORS = [1000, 5000, 10000, 20000, 50000, 100000]
+
+
+def bench(iterations, rounds):
+    hasher = passwords.PBKDF2Hasher(iterations)
+    encoded = hasher.encode(u'correct horse')
+    start = time.time()
+    for _ in xrange(rounds):
+        hasher.verify(u'bench', u'correct horse', encoded)
+    per_login = (time.time() - start) / rounds
+    return {'iterations': iterations,
+            'ms_per_login': round(per_login * 1000, 3),
+            'logins_per_cpu_second': round(1 / per_login, 1)}
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [ITERATIONS ...]')
+    parser.add_option('--rounds', type='int', default=20,
+                      help='logins timed per work factor')
+    parser.add_option('--json', action='store_true',
+                      help='print results as JSON')
+    options, args = parser.parse_args()
+    factors = [int(a) for a in args] or DEFAULT_WORK_FACTORS
+    results = [bench(n, options.rounds) for n in factors]
+    if options.json:
+        print json.dumps({'native_pbkdf2': hasattr(passwords.hashlib,
+                                                   'pbkdf2_hmac'),
+                          'results': results}, indent=2)
+        return
+    print '%10s %14s %20s' % ('iterations', 'ms/login', 'logins/cpu-second')
+    for r in results:
+        print '%10d %14.3f %20.1f' % (r['iterations'], r['ms_per_login'],
+                                      r['logins_per_cpu_second'])
+
+
+if __name__ == '__main__':
+    main()
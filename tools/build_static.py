@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# Builds fingerprinted copies of everything under static/ into static_build/.
+#
+# Each file is minified (CSS only), named after a hash of its content, e.g.
+# main.3f2a9c1b07de.css, and written next to gzip and, when the brotli
+# module is installed, brotli compressed copies. static_manifest.json maps
+# the original names to the built ones; blog.py reads it for static_url().
+# It is kept out of static_build/ because files under a static_dir cannot
+# be read by the app. app.yaml serves /static/build with a far-future
+# expiration since a built file's name changes whenever its content does.
+#
+# Run before every deploy:
+#
+#   python tools/build_static.py
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATIC_DIR = os.path.join(ROOT, 'static')
+BUILD_DIR = os.path.join(ROOT, 'static_build')
+MANIFEST = os.path.join(ROOT, 'static_manifest.json')
+
+# Characters of the content hash kept in built file names
+HASH_LENGTH = 12
+
+CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+CSS_SPACE_RE = re.compile(r'\s+')
+CSS_PUNCTUATION_RE = re.compile(r'\s*([{};,>])\s*')
+# Space before a colon is kept: "a :hover" and "a:hover" differ
+CSS_COLON_RE = re.compile(r':\s+')
+
+
+def minify_css(text):
+    text = CSS_COMMENT_RE.sub('', text)
+    text = CSS_SPACE_RE.sub(' ', text)
+    text = CSS_PUNCTUATION_RE.sub(r'\1', text)
+    text = CSS_COLON_RE.sub(':', text)
+    return text.replace(';}', '}').strip()
+
+
+MINIFIERS = {'.css': minify_css}
+
+
+def fingerprint(name, data):
+    base, ext = os.path.splitext(name)
+    digest = hashlib.md5(data).hexdigest()[:HASH_LENGTH]
+    return '%s.%s%s' % (base, digest, ext)
+
+
+def compress(path, data):
+    # Returns the sizes written, keyed by encoding
+    sizes = {}
+    with open(path + '.gz', 'wb') as raw:
+        # No file name or time in the header, so builds are reproducible
+        with gzip.GzipFile('', 'wb', 9, raw, mtime=0) as out:
+            out.write(data)
+    sizes['gzip'] = os.path.getsize(path + '.gz')
+    if brotli is not None:
+        with open(path + '.br', 'wb') as out:
+            out.write(brotli.compress(data))
+        sizes['br'] = os.path.getsize(path + '.br')
+    return sizes
+
+
+def build():
+    if os.path.isdir(BUILD_DIR):
+        shutil.rmtree(BUILD_DIR)
+    manifest = {}
+    for dirpath, _, filenames in os.walk(STATIC_DIR):
+        for filename in sorted(filenames):
+            source = os.path.join(dirpath, filename)
+            name = os.path.relpath(source, STATIC_DIR).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+            minify = MINIFIERS.get(os.path.splitext(name)[1])
+            if minify:
+                data = minify(data)
+            built = fingerprint(name, data)
+            target = os.path.join(BUILD_DIR, built)
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            with open(target, 'wb') as f:
+                f.write(data)
+            sizes = compress(target, data)
+            manifest[name] = built
+            log('%s -> %s (%d bytes from %d, %s)' % (
+                name, built, len(data), os.path.getsize(source),
+                ', '.join('%s %d' % item for item in sorted(sizes.items()))))
+    with open(MANIFEST, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def log(msg):
+    sys.stdout.write(msg + '\n')
+
+
+if __name__ == '__main__':
+    build()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# Compiles everything under templates/ into Python modules in
+# templates_compiled/. blog.py loads them through a jinja2.ModuleLoader so
+# new instances skip parsing and compiling templates on first use.
+#
+# Run before every deploy, with the same Jinja2 version app.yaml pins:
+#
+#   python tools/compile_templates.py
+
+import os
+import shutil
+import sys
+
+import jinja2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE_DIR = os.path.join(ROOT, 'templates')
+COMPILED_DIR = os.path.join(ROOT, 'templates_compiled')
+
+
+def main():
+    if os.path.isdir(COMPILED_DIR):
+        shutil.rmtree(COMPILED_DIR)
+    # Options that change generated code must match jinja_env in blog.py
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_DIR),
+                             autoescape=True)
+    env.compile_templates(COMPILED_DIR, zip=None, ignore_errors=False,
+                          log_function=log)
+
+
+def log(msg):
+    sys.stdout.write(msg + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# Streams datastore kinds to and from newline-delimited JSON.
+#
+# Export reads each kind in cursored batches and writes one entity per line,
+# so memory stays bounded however large the dataset is. Import reads lines
+# back and writes them with batched puts. Full key paths (ids, key names
+# and parents such as users_key(), blog_key() or a comment's User) are kept,
+# so exported data can be loaded into another app unchanged, and restored
+# ids are reserved so new entities never reuse them.
+#
+#   python tools/datastore_jsonl.py --sdk ~/google_appengine \
+#       --host projectsocialtap.appspot.com export > backup.jsonl
+#   python tools/datastore_jsonl.py --sdk ~/google_appengine \
+#       --host localhost:8080 import < backup.jsonl
+#
+# Both talk to the app through remote_api (enabled in app.yaml) and need an
+# admin account on deployed apps.
+
+import base64
+import datetime
+import json
+import os
+import sys
+from optparse import OptionParser
+
+# Every kind holding primary data. Posting, SearchDocument and Timeline are
+# derived and rebuilt by /_admin/reindex and the timeline jobs instead.
+DEFAULT_KINDS = ['User', 'Username', 'Post', 'Comment', 'Like', 'LikeShard',
+                 'Follow', 'FollowStats', 'PostImage']
+
+# Entities per datastore read or write
+BATCH_SIZE = 500
+
+# Smaller reads for kinds with large entities (images are up to ~900 KB)
+KIND_BATCH_SIZES = {'PostImage': 10}
+
+# Imports also write a batch once its lines add up to this many bytes
+IMPORT_BATCH_BYTES = 4 * 1024 * 1024
+
+
+def key_path(key):
+    flat = key.to_path()
+    return [list(flat[i:i + 2]) for i in xrange(0, len(flat), 2)]
+
+
+def path_key(path):
+    from google.appengine.api import datastore_types
+    flat = []
+    for kind, id_or_name in path:
+        flat.extend([kind, id_or_name])
+    return datastore_types.Key.from_path(*flat)
+
+
+def encode(value):
+    from google.appengine.api import datastore_types
+    if isinstance(value, list):
+        return [encode(v) for v in value]
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.strftime('%Y-%m-%dT%H:%M:%S.%f')}
+    if isinstance(value, datastore_types.Key):
+        return {'__key__': key_path(value)}
+    if isinstance(value, datastore_types.Text):
+        return {'__text__': value}
+    if isinstance(value, (datastore_types.Blob, datastore_types.ByteString)):
+        return {'__blob__': base64.b64encode(value),
+                'short': isinstance(value, datastore_types.ByteString)}
+    if value is None or isinstance(value, (bool, int, long, float,
+                                           basestring)):
+        return value
+    raise TypeError('cannot export %r' % type(value))
+
+
+def decode(value):
+    from google.appengine.api import datastore_types
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if '__datetime__' in value:
+        return datetime.datetime.strptime(value['__datetime__'],
+                                          '%Y-%m-%dT%H:%M:%S.%f')
+    if '__key__' in value:
+        return path_key(value['__key__'])
+    if '__text__' in value:
+        return datastore_types.Text(value['__text__'])
+    data = base64.b64decode(value['__blob__'])
+    if value.get('short'):
+        return datastore_types.ByteString(data)
+    return datastore_types.Blob(data)
+
+
+def entity_to_line(entity):
+    return json.dumps({'kind': entity.kind(),
+                       'key': key_path(entity.key()),
+                       'unindexed': sorted(entity.unindexed_properties()),
+                       'properties': dict((name, encode(value))
+                                          for name, value in entity.items())},
+                      sort_keys=True)
+
+
+def line_to_entity(line):
+    from google.appengine.api import datastore
+    record = json.loads(line)
+    key = path_key(record['key'])
+    id_or_name = {'id': key.id()} if key.id() else {'name': key.name()}
+    entity = datastore.Entity(record['kind'], parent=key.parent(),
+                              unindexed_properties=record['unindexed'],
+                              **id_or_name)
+    for name, value in record['properties'].iteritems():
+        entity[name] = decode(value)
+    return entity
+
+
+def export_kind(kind, out, batch_size=None):
+    from google.appengine.api import datastore
+    batch_size = batch_size or KIND_BATCH_SIZES.get(kind, BATCH_SIZE)
+    count = 0
+    cursor = None
+    while True:
+        query = datastore.Query(kind, cursor=cursor)
+        batch = query.Get(batch_size)
+        for entity in batch:
+            out.write(entity_to_line(entity) + '\n')
+        count += len(batch)
+        if len(batch) < batch_size:
+            return count
+        cursor = query.GetCursor()
+
+
+def put_batch(batch):
+    # Restored ids are never handed out by the id allocator, so each is
+    # reserved after the put: everything up to the highest restored id for
+    # each (parent, kind). Otherwise a later automatic id, such as the one
+    # User.register allocates, could overwrite a restored entity.
+    from google.appengine.api import datastore, datastore_types
+    datastore.Put(batch)
+    highest = {}
+    for entity in batch:
+        key = entity.key()
+        if key.id():
+            group = (key.parent(), key.kind())
+            highest[group] = max(highest.get(group, 0), key.id())
+    for (parent, kind), top in highest.iteritems():
+        datastore.AllocateIdRange(
+            datastore_types.Key.from_path(kind, 1, parent=parent), 1, top)
+
+
+def import_lines(lines, batch_size=BATCH_SIZE):
+    count = 0
+    batch = []
+    size = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        batch.append(line_to_entity(line))
+        size += len(line)
+        if len(batch) == batch_size or size >= IMPORT_BATCH_BYTES:
+            put_batch(batch)
+            count += len(batch)
+            batch = []
+            size = 0
+    if batch:
+        put_batch(batch)
+        count += len(batch)
+    return count
+
+
+def connect(sdk, host):
+    if sdk:
+        sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    from google.appengine.ext.remote_api import remote_api_stub
+    remote_api_stub.ConfigureRemoteApiForOAuth(
+        host, '/_ah/remote_api', secure=not host.startswith('localhost'))
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] export|import')
+    parser.add_option('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                      help='path to the App Engine Python SDK '
+                           '(default: $APPENGINE_SDK)')
+    parser.add_option('--host', default='localhost:8080',
+                      help='app to connect to through remote_api')
+    parser.add_option('--kinds', default=','.join(DEFAULT_KINDS),
+                      help='comma separated kinds to export')
+    parser.add_option('--file', help='read or write this file '
+                                     'instead of stdin/stdout')
+    options, args = parser.parse_args()
+    if args not in (['export'], ['import']):
+        parser.error('expected export or import')
+    connect(options.sdk, options.host)
+    if args == ['export']:
+        out = open(options.file, 'w') if options.file else sys.stdout
+        for kind in options.kinds.split(','):
+            count = export_kind(kind, out)
+            sys.stderr.write('exported %d %s entities\n' % (count, kind))
+        out.flush()
+    else:
+        lines = open(options.file) if options.file else sys.stdin
+        sys.stderr.write('imported %d entities\n' % import_lines(lines))
+
+
+if __name__ == '__main__':
+    main()
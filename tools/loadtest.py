@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# Load test for blog.app against the App Engine testbed stubs.
+#
+# Seeds users, posts and comments into a local datastore stub, then drives
+# the routes in blog.app from several threads and prints one JSON report:
+# throughput, p50/p95/p99 latency and datastore/memcache RPCs per request,
+# overall and per route. 5xx responses are counted as errors and 4xx ones,
+# such as rate limited 429s, as rejected, since they return quickly and
+# would otherwise pass for fast successes. Reports from two revisions can
+# be diffed directly.
+#
+#   python tools/loadtest.py --sdk ~/google_appengine --requests 2000 \
+#       --concurrency 8 > bench_output.txt
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Route name -> (handler class recorded by stats.py, weight in the default mix)
+ROUTES = {'blog': ('BlogFront', 40),
+          'post': ('PostPage', 30),
+          'comment': ('NewComment', 15),
+          'like': ('LikePost', 10),
+          'login': ('Login', 5)}
+
+PASSWORD = 'benchmark'
+
+
+def parse_args():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                      help='path to the App Engine Python SDK '
+                           '(default: $APPENGINE_SDK)')
+    parser.add_option('--users', type='int', default=20)
+    parser.add_option('--posts', type='int', default=200)
+    parser.add_option('--comments', type='int', default=5,
+                      help='comments per post')
+    parser.add_option('--requests', type='int', default=1000)
+    parser.add_option('--concurrency', type='int', default=4)
+    parser.add_option('--mix', default=','.join(
+        '%s=%d' % (name, weight) for name, (_, weight) in
+        sorted(ROUTES.items())),
+        help='comma separated route=weight pairs, from: %s' %
+             ', '.join(sorted(ROUTES)))
+    parser.add_option('--seed', type='int', default=0,
+                      help='random seed, for repeatable runs')
+    parser.add_option('--dataset',
+                      help='load this datastore_jsonl.py export instead of '
+                           'generating data (logins then use the wrong '
+                           'password)')
+    return parser.parse_args()[0]
+
+
+def setup_sdk(sdk):
+    if sdk:
+        sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+
+
+def activate_testbed():
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    # Indexes catch up immediately, so every run sees the same data
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_user_stub()
+    # Reads queue.yaml; jobs are run after the timed part of the test
+    bed.init_taskqueue_stub(root_path=ROOT)
+    return bed
+
+
+def seed(blog, options):
+    from google.appengine.ext import db
+    users = []
+    for i in xrange(options.users):
+        users.append(blog.User.register('bench%d' % i, PASSWORD))
+    posts = []
+    for i in xrange(options.posts):
+        author = random.choice(users)
+        post = blog.Post(subject='Post %d' % i,
+                         content='Benchmark post %d\nline two' % i,
+                         author=author.name,
+                         comment_count=options.comments)
+        # Stored HTML, as NewPost writes it
+        post.render_body()
+        posts.append(post)
+    db.put(posts)
+    comments = []
+    for p in posts:
+        for i in xrange(options.comments):
+            author = random.choice(users)
+            comments.append(blog.Comment(parent=author.key(),
+                                         post=str(p.key().id()),
+                                         comment='Comment %d' % i,
+                                         author=author.name))
+            if len(comments) >= 500:
+                db.put(comments)
+                comments = []
+    db.put(comments)
+    return users, [p.key().id() for p in posts]
+
+
+def load_dataset(blog, path):
+    import datastore_jsonl
+    with open(path) as lines:
+        datastore_jsonl.import_lines(lines)
+    users = blog.User.all().fetch(1000)
+    post_ids = [k.id() for k in blog.Post.all(keys_only=True).fetch(10000)]
+    return users, post_ids
+
+
+def build_request(blog, route, user, post_id):
+    import webob
+    cookie = 'user_id=%s' % blog.make_secure_val(str(user.key().id()))
+    if route == 'blog':
+        return webob.Request.blank('/blog')
+    if route == 'post':
+        return webob.Request.blank('/post/%d' % post_id)
+    if route == 'comment':
+        return webob.Request.blank('/post/%d/comment' % post_id,
+                                   headers={'Cookie': cookie})
+    if route == 'like':
+        return webob.Request.blank('/post/%d/likes' % post_id,
+                                   headers={'Cookie': cookie})
+    return webob.Request.blank('/login', POST={'username': user.name,
+                                               'password': PASSWORD})
+
+
+def drive(blog, options, mix, users, post_ids):
+    routes = []
+    for name, weight in mix:
+        routes.extend([name] * weight)
+    # Every random choice is made here, before the workers start, so the
+    # same --seed always sends the same requests
+    plan = [(random.choice(routes), random.choice(users),
+             random.choice(post_ids)) for _ in xrange(options.requests)]
+    results = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not plan:
+                    return
+                route, user, post_id = plan.pop()
+            request = build_request(blog, route, user, post_id)
+            start = time.time()
+            response = request.get_response(blog.app)
+            elapsed = (time.time() - start) * 1000
+            with lock:
+                results.append((route, elapsed, response.status_int))
+
+    threads = [threading.Thread(target=worker)
+               for _ in xrange(options.concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.time() - start
+
+
+def summarize(values, stats):
+    if not values:
+        return {}
+    summary = stats.percentiles(values)
+    summary['mean'] = round(sum(values) / float(len(values)), 2)
+    return summary
+
+
+def report(options, mix, results, seconds):
+    import stats
+    server = stats.samples()
+    routes = {}
+    for name, _ in mix:
+        latencies = [ms for route, ms, _ in results if route == name]
+        if not latencies:
+            continue
+        records = server.get(ROUTES[name][0], [])
+        routes[name] = {
+            'requests': len(latencies),
+            'errors': len([s for route, _, s in results
+                           if route == name and s >= 500]),
+            'rejected': len([s for route, _, s in results
+                             if route == name and 400 <= s < 500]),
+            'latency_ms': summarize(latencies, stats),
+            'datastore_rpcs': summarize(
+                [r['datastore_v3_rpcs'] for r in records], stats),
+            'memcache_rpcs': summarize(
+                [r['memcache_rpcs'] for r in records], stats),
+            'render_ms': summarize([r['render_ms'] for r in records], stats),
+        }
+    return {'config': {'users': options.users,
+                       'posts': options.posts,
+                       'comments_per_post': options.comments,
+                       'requests': options.requests,
+                       'concurrency': options.concurrency,
+                       'mix': dict(mix),
+                       'seed': options.seed},
+            'total': {'requests': len(results),
+                      'seconds': round(seconds, 3),
+                      'throughput_rps': round(len(results) / seconds, 2),
+                      'errors': len([s for _, _, s in results if s >= 500]),
+                      'rejected': len([s for _, _, s in results
+                                       if 400 <= s < 500]),
+                      'latency_ms': summarize([ms for _, ms, _ in results],
+                                              stats)},
+            'routes': routes}
+
+
+def main():
+    options = parse_args()
+    mix = []
+    for pair in options.mix.split(','):
+        name, weight = pair.split('=')
+        if name not in ROUTES:
+            sys.exit('unknown route %r' % name)
+        mix.append((name, int(weight)))
+    random.seed(options.seed)
+    setup_sdk(options.sdk)
+    bed = activate_testbed()
+    try:
+        import stats
+        # Keep every sample so the report covers the whole run
+        stats.SAMPLES_PER_ROUTE = options.requests
+        import blog
+        if options.dataset:
+            sys.path.insert(0, os.path.join(ROOT, 'tools'))
+            users, post_ids = load_dataset(blog, options.dataset)
+        else:
+            users, post_ids = seed(blog, options)
+        results, seconds = drive(blog, options, mix, users, post_ids)
+        summary = report(options, mix, results, seconds)
+        summary['total']['jobs_run'] = blog.jobs.run_pending(
+            bed.get_stub('taskqueue'))
+        print json.dumps(summary, indent=2, sort_keys=True)
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()